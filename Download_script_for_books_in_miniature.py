@@ -7,43 +7,29 @@ under the joint supervision of the University of Humboldt (Berlin) and the IRHT-
 """
 # Download script for miniatures in folio and for books in miniatures
 
-import re
 import pandas as pd
 import os
-import requests, time
-import shutil
-from PIL import Image
+from download_engine import get_engine
+from checkpoint import CheckpointLog, atomic_write_csv
+from iiif_image_api import InfoCache
 
 def download_image_from_url(image_url, dir_path, request_pause):
     """
    Downloads an image from an url and stores it as a file.
    This function is adapted from Digital Heraldry.
+   The pause between two requests to the same server is handled by the shared download engine.
     """
-    
-    print(f'Downloading image from {image_url}')
-
-    try:
-        r = requests.get(image_url, stream=True)
-        print(r.status_code)
-        # Check if image was retrieved successfully
-        if r.status_code == 200:
-            r.raw.decode_content = True
-
-            with open(dir_path, 'wb') as image_file:
-                shutil.copyfileobj(r.raw, image_file)
-            # recommended request_pause = 10 seconds
-            time.sleep(request_pause)
-        else:
-            print(f"Failed to download image from {image_url}. Status code: {r.status_code}")
-    except requests.exceptions.SSLError as e:
-        print(f"SSL Error occurred while downloading image from {image_url}. Error message: {str(e)}")
-    except Exception as e:
-        print(f"Error occurred while downloading image from {image_url}. Error message: {str(e)}")
+    # recommended request_pause = 10 seconds
+    return get_engine(request_pause).fetch(image_url, dir_path)
 
 def from_absolute_relative(absolute_coordinates, img_height, img_width):
-
+    """
+    Converts an IIIF region 'x,y,w,h' into coordinates relative to the image.
+    IIIF regions are expressed in pixels of the full resolution image: img_height and img_width
+    must be the dimensions of the full image (declared in info.json), not the ones of a reduced download.
+    """
     if absolute_coordinates:
-        x_abs, y_abs, height_abs, width_abs = map(int, absolute_coordinates.split(","))
+        x_abs, y_abs, width_abs, height_abs = map(int, absolute_coordinates.split(","))
         x_rel = x_abs / img_width
         y_rel = y_abs / img_height
         width_rel = width_abs / img_width
@@ -52,109 +38,206 @@ def from_absolute_relative(absolute_coordinates, img_height, img_width):
         # print(f"relative x: {x_rel}, relative y: {y_rel}, relative width: {width_rel}, relative height: {height_rel}")
 
 
-# Read in the CSV files
-horae_csv = pd.read_csv('Export_horae_t98.csv')
-books_csv = pd.read_csv('Books_in_Books.csv', sep=';')
-
-# Get a list of all the image URLs in books_csv
-books_urls = list(books_csv['Image_url'])
-
-# Iterate over each row in horae_csv
-for _, row in horae_csv.iterrows():
-    # Get the image URL, the institution and the shelfmark, the iiif manifest and the image canvas' number in the manifest from the current row
-    horae_url = row['image_URL']
-    horae_ms_name = row['rec_Title_full']
-    horae_manifest = row['iiif manifest']
-    horae_iiif_nb = row['image # in iiif manifest']
+# Columns of books_csv filled from the Horae export
+ENRICHED_COLUMNS = ['Full_image_url', 'Manifest_URL', 'Image_basename', 'Image_#_in_manifest',
+                    'Folio_filename', 'Miniature_coordinates', 'Miniature_filename']
 
+def enrich_books_csv(books_csv, horae_csv):
+    """
+    Adds to books_csv the data of the Horae export (full image URL, manifest, basename, canvas number,
+    filenames and miniature coordinates), matching the rows on the image URL.
+    The values are extracted from the whole 'image_URL' column at once and joined with a single merge,
+    instead of scanning books_csv for every row of horae_csv.
+    Rows of books_csv without a match keep their previous values. Returns a new DataFrame.
+    """
+    horae_urls = horae_csv['image_URL']
     # The basis of the image name is horae_ms_name, with spaces replaced by "_".
-    basename = re.sub(r"[^\w]+", "_", horae_ms_name)
-    # print(filename)
-    
+    basename = horae_csv['rec_Title_full'].str.replace(r"[^\w]+", "_", regex=True)
+    iiif_nb = horae_csv['image # in iiif manifest']
     # Extract the boundind box coordinates
-    box_coordinates = re.search(r"\d+,\d+,\d+,\d+", horae_url).group()
-    # print(box_coordinates)
-
-    # Get the URL of the full image
-    full_image_url = re.sub(r"\d+,\d+,\d+,\d+", "full", horae_url)
-    # print(full_image_url)
-
-    # Check if the image URL is in books_urls
-    if horae_url in books_urls:
-        # If the URL is in books_urls, add the iiif manifest to the 'Manifest_URL' column in books_csv
-        books_csv.loc[books_csv['Image_url'] == horae_url, 'Full_image_url'] = full_image_url
-        books_csv.loc[books_csv['Image_url'] == horae_url, 'Manifest_URL'] = horae_manifest
-        books_csv.loc[books_csv['Image_url'] == horae_url, 'Image_basename'] = basename
-        books_csv.loc[books_csv['Image_url'] == horae_url, 'Image_#_in_manifest'] = horae_iiif_nb
-        books_csv.loc[books_csv['Image_url'] == horae_url, 'Folio_filename'] = f"{basename}_{horae_iiif_nb}"
-        books_csv.loc[books_csv['Image_url'] == horae_url, 'Miniature_coordinates'] = box_coordinates
-        books_csv.loc[books_csv['Image_url'] == horae_url, 'Miniature_filename'] = f"{basename}_{horae_iiif_nb}_{box_coordinates}"
-
-
-# Save the updated books_csv
-books_csv.to_csv('Books_in_Books.csv', sep=';', index=False)
-
-# Create the directory where to save images
-output_folder = 'training_1'
-
-#This folder is for the miniatures where the books will be annotated
-miniatures_folder = 'data/Miniatures' 
-miniatures_folder = os.path.join(miniatures_folder, output_folder)
-
-if not os.path.exists(miniatures_folder):
-    os.makedirs(miniatures_folder)
-    print(f'Miniatures downloaded in {miniatures_folder}')
-
-#This folder is for the entire folio for miniatures detection
-folio_folder = 'data/Folios' 
-folio_folder = os.path.join(folio_folder, output_folder)
-
-if not os.path.exists(folio_folder):
-    os.makedirs(folio_folder)
-    print(f'Folios downloaded in {folio_folder}')
-
-# Iterate over each row in books_csv
-for _, row in books_csv.iterrows():
-    # Get the image URL, the miniature coordinates and the filename from the current row
-    image_url = row['Image_url']
-    folio_url = row['Full_image_url']
-    miniature_coordinates = row['Miniature_coordinates']
-    miniature_filename = row['Miniature_filename']
-    folio_filename = row['Folio_filename']
-    
-    # Check if the miniature_filename is not empty
-    if miniature_filename:
-        output_file_path = os.path.join(miniatures_folder, miniature_filename + '.jpg')
-        if os.path.exists(output_file_path):
-            print(f"The image {output_file_path} already dowloaded")
-            books_csv.loc[books_csv['Image_url'] == image_url, 'Miniature_filepath'] = output_file_path
-        else:
-        # Download the image
-            download_image_from_url(image_url, output_file_path, 10)
-        try:
-            books_csv.loc[books_csv['Image_url'] == image_url, 'Miniature_filepath'] = output_file_path
-        except:
-            output_file_path = ''
-
-    if folio_url:
-        output_file_path = os.path.join(folio_folder, folio_filename + '.jpg')
-        if os.path.exists(output_file_path):
-            print(f"The image {output_file_path} already dowloaded")
+    box_coordinates = horae_urls.str.extract(r"(\d+,\d+,\d+,\d+)", expand=False)
+
+    horae = pd.DataFrame({
+        'Image_url': horae_urls,
+        # Get the URL of the full image
+        'Full_image_url': horae_urls.str.replace(r"\d+,\d+,\d+,\d+", "full", regex=True),
+        'Manifest_URL': horae_csv['iiif manifest'],
+        'Image_basename': basename,
+        'Image_#_in_manifest': iiif_nb,
+        'Folio_filename': basename + '_' + iiif_nb.astype(str),
+        'Miniature_coordinates': box_coordinates,
+        'Miniature_filename': basename + '_' + iiif_nb.astype(str) + '_' + box_coordinates,
+    })
+    # As in the previous row by row update, the last row of the export wins for a duplicated URL
+    horae = horae.drop_duplicates('Image_url', keep='last')
+    horae['_matched'] = True
+
+    merged = books_csv.merge(horae, on='Image_url', how='left', suffixes=('', '_horae'))
+    merged.index = books_csv.index
+    matched = merged['_matched'].eq(True)
+
+    enriched = books_csv.copy()
+    for column in ENRICHED_COLUMNS:
+        new_values = merged[column + '_horae'] if column in books_csv.columns else merged[column]
+        if column in enriched.columns:
+            enriched[column] = new_values.where(matched, enriched[column])
         else:
-            download_image_from_url(folio_url, output_file_path, 10)
+            enriched[column] = new_values.where(matched)
+    return enriched
+
+
+def enrich_books_file(books_path='Books_in_Books.csv', horae_path='Export_horae_t98.csv', output_path=None):
+    """
+    Adds the data of the Horae export to the books csv file and saves it ('output_path', by default
+    the books csv file itself).
+    """
+    # Read in the CSV files
+    horae_csv = pd.read_csv(horae_path)
+    books_csv = pd.read_csv(books_path, sep=';')
+
+    # Add the data of the Horae export to books_csv
+    books_csv = enrich_books_csv(books_csv, horae_csv)
+
+    # Save the updated books_csv
+    atomic_write_csv(books_csv, output_path or books_path, sep=';', index=False)
+
+
+def download_books(books_path='Books_in_Books.csv', data_folder='data', output_folder='training_1',
+                   target_size=None, output_path=None):
+    """
+    Downloads the miniatures and the folios of the (enriched) books csv file, and saves the table with
+    the paths and the sizes of the images in 'output_path' (by default the books csv file itself).
+    With 'target_size' (e.g. 1280), the images are asked to the IIIF server so that they fit
+    in target_size x target_size pixels, instead of being downloaded at full resolution.
+    """
+    books_csv = pd.read_csv(books_path, sep=';')
+    output_path = output_path or books_path
+
+    #This folder is for the miniatures where the books will be annotated
+    miniatures_folder = os.path.join(data_folder, 'Miniatures', output_folder)
+
+    if not os.path.exists(miniatures_folder):
+        os.makedirs(miniatures_folder)
+        print(f'Miniatures downloaded in {miniatures_folder}')
+
+    #This folder is for the entire folio for miniatures detection
+    folio_folder = os.path.join(data_folder, 'Folios', output_folder)
+
+    if not os.path.exists(folio_folder):
+        os.makedirs(folio_folder)
+        print(f'Folios downloaded in {folio_folder}')
+
+    # The journal records the state of every download, so that an interrupted run can be resumed,
+    # and the dedup index the content of every image, so that a folio reached by several rows is stored once
+    engine = get_engine(10, journal_path=os.path.join(data_folder, 'download_journal.sqlite'),
+                        dedup_path=os.path.join(data_folder, '.dedup_index.sqlite'))
+    journal = engine.journal
+
+    # URL actually requested for each image URL, and the info.json of its image service
+    info_cache = InfoCache(engine.get, os.path.join(data_folder, 'iiif_info_cache')) if target_size else None
+    requested = {}
+
+    def request_url(url):
+        if url not in requested:
+            if info_cache is None:
+                requested[url] = (url, None)
+            else:
+                try:
+                    requested[url] = info_cache.sized_url(url, target_size, target_size)
+                except Exception as e:
+                    print(f"No info.json for {url}, downloaded at full size. Error message: {str(e)}")
+                    requested[url] = (url, None)
+        return requested[url]
+
+    # Collect the images to download, so that they can be fetched concurrently.
+    # The jobs are keyed by output path: the folio of several miniatures (or a repeated row) is downloaded once
+    download_jobs = {}
+    for _, row in books_csv.iterrows():
+        # Get the image URL, the miniature coordinates and the filename from the current row
+        image_url = row['Image_url']
+        folio_url = row['Full_image_url']
+        miniature_filename = row['Miniature_filename']
+        folio_filename = row['Folio_filename']
+
+        # Check if the miniature_filename is not empty
+        if isinstance(miniature_filename, str) and miniature_filename:
+            output_file_path = os.path.join(miniatures_folder, miniature_filename + '.jpg')
+            download_url, _ = request_url(image_url)
+            if journal.is_downloaded(download_url, output_file_path):
+                print(f"The image {output_file_path} already dowloaded")
+            elif output_file_path not in download_jobs:
+                download_jobs[output_file_path] = download_url
+
+        if isinstance(folio_url, str) and folio_url:
+            output_file_path = os.path.join(folio_folder, folio_filename + '.jpg')
+            download_url, _ = request_url(folio_url)
+            if journal.is_downloaded(download_url, output_file_path):
+                print(f"The image {output_file_path} already dowloaded")
+            elif output_file_path not in download_jobs:
+                download_jobs[output_file_path] = download_url
+
+    # Download the images, one token bucket per IIIF server (recommended request_pause = 10 seconds)
+    engine.download_all([(url, path) for path, url in download_jobs.items()])
+
+    # The results of each row are appended to a log, flushed every 100 rows or 30 seconds,
+    # and the table is only written once at the end
+    checkpoint = CheckpointLog(os.path.splitext(output_path)[0] + '.checkpoint.jsonl', 'Image_url', flush_every=100, flush_interval=30)
+
+    # Iterate over each row in books_csv
+    for _, row in books_csv.iterrows():
+        # Get the image URL, the miniature coordinates and the filename from the current row
+        image_url = row['Image_url']
+        folio_url = row['Full_image_url']
+        miniature_coordinates = row['Miniature_coordinates']
+        miniature_filename = row['Miniature_filename']
+        folio_filename = row['Folio_filename']
+
+        # Rows already processed by an interrupted run are not processed again
+        if image_url in checkpoint:
+            continue
+        result = {'Image_url': image_url}
+    
+        # Check if the miniature_filename is not empty
+        if isinstance(miniature_filename, str) and miniature_filename:
+            output_file_path = os.path.join(miniatures_folder, miniature_filename + '.jpg')
+            if journal.is_done(request_url(image_url)[0], output_file_path):
+                result['Miniature_filepath'] = output_file_path
+
+        if isinstance(folio_url, str) and folio_url:
+            output_file_path = os.path.join(folio_folder, folio_filename + '.jpg')
+            result['Folio_filepath'] = output_file_path
         
-        try:
-            books_csv.loc[books_csv['Image_url'] == image_url, 'Folio_filepath'] = output_file_path
-
-            img_height, img_width = Image.open(output_file_path).size
-            relative_coords = from_absolute_relative(box_coordinates, img_height, img_width)
-            books_csv.loc[books_csv['Image_url'] == image_url, 'FolioHeightAsDownloaded'] = img_height
-            books_csv.loc[books_csv['Image_url'] == image_url, 'FolioWidthAsDownloaded'] = img_width
-            books_csv.loc[books_csv['Image_url'] == image_url, 'relative_coordinates'] = relative_coords
-        except:
-            output_file_path = ''
-            img_height =''
-            img_width = ''
-            relative_coords = ''
-
-    books_csv.to_csv('Books_in_Books.csv', sep=';', index=False)
+            try:
+                download_url, info = request_url(folio_url)
+                # Read from the journal, or from the header of the image
+                img_width, img_height = engine.image_size(download_url, output_file_path)
+                # The miniature coordinates are given in pixels of the full resolution folio
+                if info is not None:
+                    full_width, full_height = info['width'], info['height']
+                    result['FolioHeightAsDeclared'] = full_height
+                    result['FolioWidthAsDeclared'] = full_width
+                else:
+                    full_width, full_height = img_width, img_height
+                relative_coords = from_absolute_relative(miniature_coordinates, full_height, full_width)
+                result['FolioHeightAsDownloaded'] = img_height
+                result['FolioWidthAsDownloaded'] = img_width
+                result['relative_coordinates'] = relative_coords
+            except:
+                pass
+
+        checkpoint.append(result)
+
+    # Rebuild the final table from the log and save it
+    books_csv = checkpoint.rebuild(books_csv)
+    atomic_write_csv(books_csv, output_path, sep=';', index=False)
+    checkpoint.remove()
+
+
+def main(target_size=None):
+    """Enriches Books_in_Books.csv and downloads the miniatures and the folios (see download_books)."""
+    enrich_books_file('Books_in_Books.csv', 'Export_horae_t98.csv')
+    download_books('Books_in_Books.csv', 'data', 'training_1', target_size=target_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,29 @@ under the joint supervision of the University of Humboldt (Berlin) and the IRHT-
 ---
 """
 
+import importlib.util
 import os
-import glob
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from label_store import NB_COLUMNS, LabelStore, build_label_store
+
+
+# Noms des classes, indexés par le code de classe YOLO (le code est utilisé si la classe n'est pas renseignée)
+CLASS_NAMES = {}
+
+
+def get_class_name(class_code):
+    class_code = int(float(class_code))
+    return CLASS_NAMES.get(class_code, str(class_code))
 
 
 """
 Le code la fonction 'calculate_iou' est adapté de la fonction 'bb_intersection_over_union' issue de https://pyimagesearch.com/2016/11/07/intersection-over-union-iou-for-object-detection/
 L'adaptation a été nécessaire car 'bb_intersection_over_union' les coordonnées utilisées sont données en x_min, y_min, x_max, y_max).
 Or, les coordonnées issues de YOLOv7 pour chaque annotation sont relatives et données en x, y, w, h.
+Les coordonnées étant relatives (entre 0 et 1), le '+ 1' de la version en pixels n'est pas ajouté aux largeurs et hauteurs.
 """
 
 
@@ -36,18 +51,131 @@ def calculate_iou(box1, box2):
     y_max = min(box1_y_max, box2_y_max)
     
     # Calculer l'aire de l'intersection
-    intersection_area = max(0, x_max - x_min + 1) * max(0, y_max - y_min + 1)
+    intersection_area = max(0, x_max - x_min) * max(0, y_max - y_min)
 
     # Calculer l'aire des deux bounding boxes
-    box1_area = (box1_x_max - box1_x_min + 1) * (box1_y_max - box1_y_min + 1)
-    box2_area = (box2_x_max - box2_x_min + 1) * (box2_y_max - box2_y_min + 1)
+    box1_area = (box1_x_max - box1_x_min) * (box1_y_max - box1_y_min)
+    box2_area = (box2_x_max - box2_x_min) * (box2_y_max - box2_y_min)
     
     # Calculer l'Intersection over Union (IoU)
-    iou = intersection_area / float(box1_area + box2_area - intersection_area)
+    union_area = box1_area + box2_area - intersection_area
+    if union_area <= 0:
+        return 0.0
+    iou = intersection_area / float(union_area)
     
     return iou
 
 
+"""
+Version vectorisée : les fichiers de labels sont lus une seule fois et convertis en tableaux NumPy (N, 5)
+(classe, x, y, w, h), ou (N, 6) lorsque les prédictions contiennent la confiance (option --save-conf de YOLOv7).
+La matrice des IoU entre toutes les annotations et toutes les prédictions est calculée d'un seul coup par broadcasting.
+"""
+
+
+def parse_boxes(lines):
+    """Convertit des lignes YOLO ('classe x y w h [confiance]') en tableau NumPy (N, 5) ou (N, 6)."""
+    rows = [line.split() for line in lines if line.strip()]
+    if not rows:
+        return np.zeros((0, 5), dtype=np.float64)
+    width = max(len(row) for row in rows)
+    boxes = np.full((len(rows), width), np.nan, dtype=np.float64)
+    for i, row in enumerate(rows):
+        boxes[i, :len(row)] = [float(value) for value in row]
+    return boxes
+
+
+def load_boxes(file_path):
+    """Lit un fichier de labels YOLO et retourne ses boîtes sous forme de tableau NumPy."""
+    with open(file_path, 'r') as file:
+        return parse_boxes(file.readlines())
+
+
+def iou_matrix(boxes1, boxes2):
+    """Matrice (N, M) des IoU entre les boîtes (classe, x, y, w, h, ...) de boxes1 et de boxes2."""
+    if len(boxes1) == 0 or len(boxes2) == 0:
+        return np.zeros((len(boxes1), len(boxes2)), dtype=np.float64)
+
+    # Convertir les coordonnées (x, y, w, h) en coordonnées (x_min, y_min, x_max, y_max)
+    min1 = boxes1[:, 1:3] - boxes1[:, 3:5] / 2
+    max1 = boxes1[:, 1:3] + boxes1[:, 3:5] / 2
+    min2 = boxes2[:, 1:3] - boxes2[:, 3:5] / 2
+    max2 = boxes2[:, 1:3] + boxes2[:, 3:5] / 2
+
+    # Intersection de chaque couple de boîtes
+    intersection_min = np.maximum(min1[:, None, :], min2[None, :, :])
+    intersection_max = np.minimum(max1[:, None, :], max2[None, :, :])
+    intersection_area = np.clip(intersection_max - intersection_min, 0, None).prod(axis=2)
+
+    area1 = (boxes1[:, 3] * boxes1[:, 4])[:, None]
+    area2 = (boxes2[:, 3] * boxes2[:, 4])[None, :]
+    union_area = area1 + area2 - intersection_area
+    return np.divide(intersection_area, union_area, out=np.zeros_like(intersection_area), where=union_area > 0)
+
+
+def prediction_order(predictions):
+    """Indices des prédictions par confiance décroissante (ordre du fichier si la confiance est absente)."""
+    if predictions.shape[1] >= 6 and not np.isnan(predictions[:, 5]).all():
+        return np.argsort(-np.nan_to_num(predictions[:, 5], nan=0.0), kind='stable')
+    return np.arange(len(predictions))
+
+
+def assign_greedy(ious, order, threshold):
+    """
+    Appariement un pour un à la manière de COCO : les prédictions sont parcourues par confiance décroissante,
+    et chacune est associée à l'annotation encore libre avec laquelle son IoU est le plus grand (au moins 'threshold').
+    'ious' est la matrice (annotations, prédictions). Retourne une liste de couples (annotation, prédiction).
+    """
+    pairs = []
+    free = np.ones(ious.shape[0], dtype=bool)
+    for j in order:
+        if not free.any():
+            break
+        candidates = np.where(free, ious[:, j], -1.0)
+        i = int(np.argmax(candidates))
+        if candidates[i] >= threshold:
+            free[i] = False
+            pairs.append((i, int(j)))
+    return pairs
+
+
+def assign_hungarian(ious, threshold):
+    """Appariement un pour un qui maximise la somme des IoU au-dessus du seuil (algorithme hongrois, nécessite scipy)."""
+    from scipy.optimize import linear_sum_assignment
+
+    # Les IoU sous le seuil ne comptent pas : sinon elles pourraient écarter un appariement valide
+    weights = np.where(ious >= threshold, ious, 0.0)
+    rows, cols = linear_sum_assignment(-weights)
+    return [(int(i), int(j)) for i, j in zip(rows, cols) if ious[i, j] >= threshold]
+
+
+def match_box_arrays(annotations, predictions, threshold, method='greedy'):
+    """
+    Appariement des boîtes annotées et prédites, classe par classe.
+    'annotations' et 'predictions' sont des tableaux NumPy (N, 5+) et (M, 5+).
+    'method' vaut 'greedy' (ordre de confiance, comme COCO) ou 'hungarian'.
+    Retourne (matches, false_positives, false_negatives) : matches est une liste de triplets
+    (indice annotation, indice prédiction, IoU), les deux autres des listes d'indices.
+    """
+    matches = []
+    if len(annotations) and len(predictions):
+        for class_code in np.intersect1d(annotations[:, 0], predictions[:, 0]):
+            ann_idx = np.flatnonzero(annotations[:, 0] == class_code)
+            pred_idx = np.flatnonzero(predictions[:, 0] == class_code)
+            ious = iou_matrix(annotations[ann_idx], predictions[pred_idx])
+            if method == 'hungarian':
+                pairs = assign_hungarian(ious, threshold)
+            else:
+                pairs = assign_greedy(ious, prediction_order(predictions[pred_idx]), threshold)
+            matches.extend((int(ann_idx[i]), int(pred_idx[j]), float(ious[i, j])) for i, j in pairs)
+
+    matched_annotations = {i for i, _, _ in matches}
+    matched_predictions = {j for _, j, _ in matches}
+    false_positives = [j for j in range(len(predictions)) if j not in matched_predictions]
+    false_negatives = [i for i in range(len(annotations)) if i not in matched_annotations]
+    return matches, false_positives, false_negatives
+
+
 """
 La fonction match_boxes permet de retourner les bbxes annotées et leur correspondance prédite.
 Cette fonction permet également de retourner les faux positifs (objet prédits alors qu'il n'y pas d'équivalent dans la vérité terrain) et 
@@ -58,38 +186,21 @@ faux positifs (si issu de prédiction).
 Ce dernier 'threshold' est par défaut implémenter à 0.50, ce qui correspond aux recommandations du PASCAL VOC challenge ou à à 0.75 (détection strict) :
 https://cocodataset.org/?ref=jeremyjordan.me#detection-eval.
 Avec un 'threshold' à 0.1 les erreurs de localisation sont ignorées.
+Chaque prédiction ne peut être associée qu'à une seule annotation (et inversement).
  """
 
-def match_boxes(annotations, predictions, threshold):
-    matched_annotations = []
-    matched_predictions = []
-
-    for annotation in annotations:
-        annotation_box = annotation.split(" ")
-        annotation_box = [float(coord) for coord in annotation_box]
-        annotation_class = int(annotation_box[0])
-
-        best_iou = 0
-        best_prediction_idx = -1
-
-        for i, prediction in enumerate(predictions):
-            prediction_box = prediction.split(" ")
-            prediction_box = [float(coord) for coord in prediction_box]
-            prediction_class = int(prediction_box[0])
-
-            if  annotation_class == prediction_class:
-                iou = calculate_iou(annotation_box, prediction_box)
+def match_boxes(annotations, predictions, threshold, method='greedy'):
+    annotation_boxes = parse_boxes(annotations)
+    prediction_boxes = parse_boxes(predictions)
+    annotations = [a for a in annotations if a.strip()]
+    predictions = [p for p in predictions if p.strip()]
 
-                if iou > best_iou and iou >= threshold:
-                    best_iou = iou
-                    best_prediction_idx = i
+    matches, false_positives, false_negatives = match_box_arrays(annotation_boxes, prediction_boxes, threshold, method)
 
-        if best_prediction_idx != -1:
-            matched_annotations.append(annotation)
-            matched_predictions.append(predictions[best_prediction_idx])
-
-    false_positives = [p for p in predictions if p not in matched_predictions]
-    false_negatives = [a for a in annotations if a not in matched_annotations]
+    matched_annotations = [annotations[i] for i, _, _ in matches]
+    matched_predictions = [predictions[j] for _, j, _ in matches]
+    false_positives = [predictions[j] for j in false_positives]
+    false_negatives = [annotations[i] for i in false_negatives]
 
     return matched_annotations, matched_predictions, false_positives, false_negatives
 
@@ -103,48 +214,178 @@ def load_data_from_files(file_paths):
                 data_list.append(line.strip())
     return data_list
 
-directory_results = ''
-output_file = os.path.join(directory_results,'results_for_graphics.csv')   # Nom du fichier de sortie
-
-# Get annotation files
-img_ann_dir = os.path.join(directory_results, 'labels_ann')
-ann_files = glob.glob(os.path.join(img_ann_dir, '*.txt'))
-annotations = load_data_from_files(ann_files)
-
-# Get prediction files
-img_pred_dir = os.path.join(directory_results, 'labels_pred')
-pred_files = glob.glob(os.path.join(img_pred_dir, '*.txt'))
-predictions = load_data_from_files(pred_files)
+"""
+Appariement des fichiers d'annotations et de prédictions : chaque dossier est parcouru une seule fois avec os.scandir
+pour construire un index nom de fichier -> chemin. Les images qui n'ont que des annotations (aucune prédiction)
+ou que des prédictions (aucune annotation) sont conservées : toutes leurs boîtes sont des FN ou des FP.
+"""
 
-with open(output_file, 'w', newline='') as csvfile:
-    fieldnames = ['Filename', 'Box_coordinates', 'TP/FP/FN', 'classe', 'Matched_boxes', 'IoU']  # Ajout des nouvelles colonnes
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
 
-    for ann_file in ann_files:
-        ann_file_name = os.path.basename(ann_file)
-        matching_pred_files = [pred_file for pred_file in pred_files if os.path.basename(pred_file) == ann_file_name]
-        if len(matching_pred_files) > 0:
-            annotations = load_data_from_files([ann_file])
-            predictions = load_data_from_files(matching_pred_files)
+def index_label_files(directory):
+    """Retourne un dictionnaire {nom du fichier .txt: chemin} pour un dossier de labels."""
+    index = {}
+    if not os.path.isdir(directory):
+        return index
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt') and entry.is_file():
+                index[entry.name] = entry.path
+    return index
 
-            matched_annotations, matched_predictions, false_positives, false_negatives = match_boxes(annotations, predictions, threshold=0.5)
 
-            for annotation, prediction in zip(matched_annotations, matched_predictions):
-                iou = calculate_iou([float(coord) for coord in annotation.split(" ")], [float(coord) for coord in prediction.split(" ")])
-                box_coordinates = ' '.join(annotation.split(" "))
+def pair_label_files(ann_dir, pred_dir):
+    """
+    Génère des triplets (nom du fichier, fichier d'annotations, fichier de prédictions), triés par nom.
+    Le chemin vaut None lorsque l'un des deux fichiers n'existe pas.
+    """
+    ann_index = index_label_files(ann_dir)
+    pred_index = index_label_files(pred_dir)
+    for name in sorted(ann_index.keys() | pred_index.keys()):
+        yield name, ann_index.get(name), pred_index.get(name)
 
-                writer.writerow({'Filename': os.path.basename(ann_file), 'Box_coordinates': box_coordinates, 'TP/FP/FN': 'TP', 'classe': get_class_name(annotation[0]), 'Matched_boxes': prediction, 'IoU': iou})
 
-            if len(false_positives) != 0:
-                for false_positive in false_positives:
-                    writer.writerow({'Filename': os.path.basename(ann_file), 'Box_coordinates': false_positive, 'TP/FP/FN': 'FP', 'classe': get_class_name(false_positive[0]), 'Matched_boxes': '', 'IoU': ''})
+# Colonnes du fichier de résultats
+RESULT_COLUMNS = ['Filename', 'Box_coordinates', 'TP/FP/FN', 'classe', 'Matched_boxes', 'IoU']
 
-            if len(false_negatives) != 0:
-                for false_negative in false_negatives:
-                    writer.writerow({'Filename': os.path.basename(ann_file), 'Box_coordinates': false_negative, 'TP/FP/FN': 'FN', 'classe': get_class_name(false_negative[0]), 'Matched_boxes': '', 'IoU': ''})
 
+"""
+Les boîtes sont lues dans les label stores des dossiers d'annotations et de prédictions (voir label_store.py) :
+chaque dossier est lu dans un seul fichier, et seuls les fichiers de labels modifiés depuis la dernière évaluation
+sont relus. Les processus ouvrent les stores par memory mapping, seuls les noms des fichiers leur sont transmis.
+"""
 
 
-# Afficher un message lorsque l'écriture dans le fichier est terminée
-print("Les résultats ont été enregistrés dans le fichier", output_file)
+def open_label_stores(ann_dir, pred_dir):
+    """
+    Construit ou met à jour les label stores de ann_dir et pred_dir, et retourne (store des annotations,
+    store des prédictions, noms triés de tous les fichiers de labels). Un dossier absent n'a pas de store (None).
+    """
+    stores = [build_label_store(directory) if os.path.isdir(directory) else None for directory in (ann_dir, pred_dir)]
+    names = sorted(set().union(*(store.names for store in stores if store is not None)))
+    return stores[0], stores[1], names
+
+
+def store_boxes(store, name):
+    """Boîtes (N, 6) d'un fichier de labels du store, en float64 (tableau vide si le fichier n'existe pas)."""
+    if store is None or name not in store:
+        return np.zeros((0, NB_COLUMNS), dtype=np.float64)
+    return np.asarray(store.boxes_of(name), dtype=np.float64)
+
+
+def format_box(box):
+    """Ligne YOLO d'une boîte (classe x y w h [confiance]) pour le fichier de résultats."""
+    values = [str(int(box[0]))] + [str(np.float32(value)) for value in box[1:5]]
+    if not np.isnan(box[5]):
+        values.append(str(np.float32(box[5])))
+    return ' '.join(values)
+
+
+def append_result_rows(columns, filename, annotations, predictions, matches, false_positives, false_negatives):
+    """Ajoute les lignes TP, FP et FN d'une image aux listes de 'columns' (un dictionnaire colonne -> liste)."""
+    rows = [(format_box(annotations[i]), 'TP', annotations[i, 0], format_box(predictions[j]), iou)
+            for i, j, iou in matches]
+    rows += [(format_box(predictions[j]), 'FP', predictions[j, 0], '', None) for j in false_positives]
+    rows += [(format_box(annotations[i]), 'FN', annotations[i, 0], '', None) for i in false_negatives]
+
+    for box, kind, class_code, matched_box, iou in rows:
+        columns['Filename'].append(filename)
+        columns['Box_coordinates'].append(box)
+        columns['TP/FP/FN'].append(kind)
+        columns['classe'].append(get_class_name(class_code))
+        columns['Matched_boxes'].append(matched_box)
+        columns['IoU'].append(iou)
+
+
+def evaluate_image(name, annotations, predictions, columns, threshold=0.5, method='greedy'):
+    """
+    Ajoute les TP, FP et FN d'une image aux listes de 'columns'.
+    Sans fichier d'annotations, toutes les prédictions sont des FP ; sans fichier de prédictions, toutes les annotations sont des FN.
+    """
+    matches, false_positives, false_negatives = match_box_arrays(annotations, predictions, threshold, method)
+    append_result_rows(columns, name, annotations, predictions, matches, false_positives, false_negatives)
+
+
+def evaluate_shard(ann_store_dir, pred_store_dir, names, threshold=0.5, method='greedy'):
+    """Évalue une liste de fichiers de labels, lus dans les label stores ; exécuté dans un processus."""
+    ann_store = LabelStore(ann_store_dir) if ann_store_dir else None
+    pred_store = LabelStore(pred_store_dir) if pred_store_dir else None
+    columns = {column: [] for column in RESULT_COLUMNS}
+    for name in names:
+        evaluate_image(name, store_boxes(ann_store, name), store_boxes(pred_store, name), columns, threshold, method)
+    return columns
+
+
+def evaluate_directories(ann_dir, pred_dir, threshold=0.5, method='greedy', workers=None, shard_size=256):
+    """
+    Évalue toutes les images de ann_dir et pred_dir. Les fichiers sont répartis par paquets ('shard_size')
+    entre les processus ('workers', par défaut le nombre de cœurs), puis les résultats sont fusionnés.
+    Retourne un DataFrame avec une ligne par boîte.
+    """
+    ann_store, pred_store, names = open_label_stores(ann_dir, pred_dir)
+    store_dirs = tuple(store.store_dir if store is not None else None for store in (ann_store, pred_store))
+    shards = [names[i:i + shard_size] for i in range(0, len(names), shard_size)]
+
+    columns = {column: [] for column in RESULT_COLUMNS}
+    if workers == 1 or len(shards) <= 1:
+        results = (evaluate_shard(*store_dirs, shard, threshold, method) for shard in shards)
+        for result in results:
+            for column in RESULT_COLUMNS:
+                columns[column].extend(result[column])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(evaluate_shard, *store_dirs, shard, threshold, method) for shard in shards]
+            # Les paquets sont fusionnés dans l'ordre, le résultat ne dépend donc pas du nombre de processus
+            for future in futures:
+                result = future.result()
+                for column in RESULT_COLUMNS:
+                    columns[column].extend(result[column])
+
+    results = pd.DataFrame(columns, columns=RESULT_COLUMNS)
+    results['IoU'] = results['IoU'].astype('float64')
+    return results
+
+
+def parquet_engine():
+    """Moteur Parquet installé ('pyarrow' ou 'fastparquet'), ou None."""
+    for engine in ('pyarrow', 'fastparquet'):
+        if importlib.util.find_spec(engine) is not None:
+            return engine
+    return None
+
+
+def save_results(results, output_file):
+    """
+    Enregistre les résultats en une seule écriture : en Parquet si l'extension est .parquet et qu'un moteur
+    Parquet (pyarrow ou fastparquet) est installé, sinon en CSV. Retourne le chemin du fichier écrit.
+    """
+    if output_file.endswith('.parquet'):
+        engine = parquet_engine()
+        if engine is not None:
+            results.to_parquet(output_file, index=False, engine=engine)
+            return output_file
+        output_file = os.path.splitext(output_file)[0] + '.csv'
+        print(f"Ni pyarrow ni fastparquet n'est installé : résultats enregistrés en CSV dans {output_file}")
+    results.to_csv(output_file, index=False)
+    return output_file
+
+
+if __name__ == '__main__':
+    directory_results = ''
+    output_file = os.path.join(directory_results,'results_for_graphics.csv')   # Nom du fichier de sortie (.parquet si pyarrow est installé)
+
+    # Dossiers des fichiers d'annotations et de prédictions
+    img_ann_dir = os.path.join(directory_results, 'labels_ann')
+    img_pred_dir = os.path.join(directory_results, 'labels_pred')
+
+    pairs = [(ann_file, pred_file) for _, ann_file, pred_file in pair_label_files(img_ann_dir, img_pred_dir)]
+    only_annotations = sum(1 for _, pred_file in pairs if pred_file is None)
+    only_predictions = sum(1 for ann_file, _ in pairs if ann_file is None)
+
+    results = evaluate_directories(img_ann_dir, img_pred_dir, threshold=0.5)
+    output_file = save_results(results, output_file)
+
+    print(f"{only_annotations} images sans prédictions (toutes les annotations sont des FN)")
+    print(f"{only_predictions} images sans annotations (toutes les prédictions sont des FP)")
+
+    # Afficher un message lorsque l'écriture dans le fichier est terminée
+    print("Les résultats ont été enregistrés dans le fichier", output_file)
@@ -1,6 +1,10 @@
 import os
 import re
-import codecs
+import json
+import math
+from collections import Counter
+
+from label_store import build_label_store, decode_annotation, parse_label_file
 
 """
 Marion Charpier
@@ -63,10 +67,7 @@ def occurences(folder):
             ms_name = match.group(1)
             noms_fichiers.append(ms_name)
     # Comptage des occurrences
-    occurrences = {}
-    for nom in noms_fichiers:
-        if nom not in occurrences:
-            occurrences[nom] = noms_fichiers.count(nom)
+    occurrences = Counter(noms_fichiers)
 
     # Tri des résultats par nombre décroissant
     resultats_tries = sorted(occurrences.items(), key=lambda x: x[1], reverse=True)
@@ -107,14 +108,11 @@ def encoding(folder):
         file_path = os.path.join(folder, filename)
         with open(file_path, 'rb') as f:
             rawdata = f.read()
-        try:
-            result = codecs.decode(rawdata, 'utf-8')
-        except UnicodeDecodeError:
-            try:
-                result = codecs.decode(rawdata, 'iso-8859-1')
-                print(f"{filename} is encoded in ISO-8859-1")
-            except UnicodeDecodeError:
-                print(f"{filename} encoding not recognized")
+        result, file_encoding = decode_annotation(rawdata)
+        if file_encoding == 'iso-8859-1':
+            print(f"{filename} is encoded in ISO-8859-1")
+        elif file_encoding is None:
+            print(f"{filename} encoding not recognized")
 
 
 #Fonction pour récupérer le nombre d'images sans annotations                
@@ -189,3 +187,138 @@ def annotations_classes(folder):
     
     for coa_code, nb_occurences in occurences.items():
         print(f"{coa_code} : {nb_occurences} occurences")
+
+
+
+"""
+Toutes les statistiques en un seul passage
+"""
+
+# Expression régulière du nom des images : <nom du manuscrit>_<numéro>.<extension>
+IDNO = re.compile(r'^(.+)_\d+\.(jpg|jpeg|png)$')
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+# Résumé de la taille des boîtes d'un fichier d'annotations
+BOX_SIZE_KEYS = ('boxes', 'sum_width', 'sum_height', 'min_area', 'max_area')
+
+
+#Fonction pour récupérer les statistiques d'un fichier d'annotations à partir de ses boîtes (N, 6),
+#de son nombre de lignes et de son encodage (voir label_store.parse_label_file)
+def label_statistics(boxes, nb_lignes, file_encoding):
+    classes = Counter(str(int(class_code)) for class_code in boxes[:, 0].tolist())
+    largeurs, hauteurs = boxes[:, 3].astype('float64'), boxes[:, 4].astype('float64')
+    aires = largeurs * hauteurs
+    # Résumé de la taille des boîtes (largeur et hauteur relatives)
+    tailles = {
+        'boxes': len(boxes),
+        'sum_width': float(largeurs.sum()),
+        'sum_height': float(hauteurs.sum()),
+        'min_area': float(aires.min()) if len(boxes) else None,
+        'max_area': float(aires.max()) if len(boxes) else None,
+    }
+    return {
+        'empty': nb_lignes == 0,
+        'lines': nb_lignes,
+        'annotations': len(boxes),
+        'classes': classes,
+        'encoding': file_encoding,
+        'box_sizes': tailles,
+    }
+
+
+#Fonction pour récupérer les statistiques d'un fichier d'annotations (exécutée dans un processus)
+def annotation_file_statistics(file_path):
+    return label_statistics(*parse_label_file(file_path))
+
+
+#Fonction pour calculer toutes les statistiques en un seul parcours du dossier
+def collect_statistics(folder, workers=None, parallel_above=2000):
+    """
+    Le dossier est listé une seule fois et les boîtes sont lues dans le label store du dossier
+    (voir label_store.py) : seuls les fichiers d'annotations ajoutés ou modifiés sont relus.
+    Au-delà de 'parallel_above' fichiers à lire, la lecture est répartie entre 'workers' processus.
+    Retourne un dictionnaire avec toutes les statistiques.
+    """
+    with os.scandir(folder) as entries:
+        filenames = [entry.name for entry in entries if entry.is_file()]
+    noms = set(filenames)
+
+    image_files = sorted(filename for filename in filenames if filename.endswith(IMAGE_EXTENSIONS))
+    annotation_files = []
+    for image_file in image_files:
+        annotation_file = f"{os.path.splitext(image_file)[0]}.txt"
+        if annotation_file in noms:
+            annotation_files.append(annotation_file)
+
+    # Distribution des annotations, lue dans le label store du dossier (seuls les fichiers modifiés sont relus)
+    store = build_label_store(folder, workers=workers, parallel_above=parallel_above)
+    file_statistics = [label_statistics(store.boxes_of(annotation_file), store.lines[annotation_file],
+                                        store.encodings[annotation_file]) for annotation_file in annotation_files]
+
+    classes = Counter()
+    for statistics in file_statistics:
+        classes.update(statistics['classes'])
+    per_file = {annotation_file: (statistics['lines'], statistics['empty'], statistics['encoding'])
+                for annotation_file, statistics in zip(annotation_files, file_statistics)}
+    box_sizes = [tuple(statistics['box_sizes'][key] for key in BOX_SIZE_KEYS) for statistics in file_statistics]
+    return statistics_summary(folder, image_files, annotation_files, classes, per_file, box_sizes)
+
+
+#Fonction pour assembler le rapport des statistiques à partir des statistiques des fichiers d'annotations
+#(utilisée aussi par statistics_cache.py, pour que le rapport soit le même avec ou sans le cache)
+def statistics_summary(folder, image_files, annotation_files, classes, per_file, box_sizes):
+    """
+    'annotation_files' est dans l'ordre des images, 'classes' un Counter {classe: nombre d'annotations},
+    'per_file' un dictionnaire {fichier d'annotations: (nombre de lignes, vide, encodage)} et 'box_sizes'
+    la liste des résumés de la taille des boîtes de chaque fichier (valeurs de BOX_SIZE_KEYS).
+    """
+    # Distribution des sources annotées
+    occurrences = Counter()
+    for nom_fichier in image_files:
+        match = IDNO.match(nom_fichier)
+        if match:
+            occurrences[match.group(1)] += 1
+
+    annotations_par_image = {annotation_file: per_file[annotation_file][0] for annotation_file in annotation_files}
+    fichiers_vides = [annotation_file for annotation_file in annotation_files if per_file[annotation_file][1]]
+    encodages = {annotation_file: per_file[annotation_file][2] or 'not recognized'
+                 for annotation_file in annotation_files if per_file[annotation_file][2] != 'utf-8'}
+
+    # Les sommes sont calculées avec math.fsum : le résultat ne dépend pas de l'ordre des fichiers
+    nb_boxes = sum(sizes[0] for sizes in box_sizes)
+    min_areas = [sizes[3] for sizes in box_sizes if sizes[3] is not None]
+    max_areas = [sizes[4] for sizes in box_sizes if sizes[4] is not None]
+
+    return {
+        'folder': folder,
+        'images': len(image_files),
+        'annotation_files': len(annotation_files),
+        'nb_manuscripts': len(occurrences),
+        'occurrences': dict(occurrences.most_common()),
+        'img_without_annotations': len(fichiers_vides),
+        'empty_annotation_files': fichiers_vides,
+        'annotations_per_img': dict(sorted(annotations_par_image.items(), key=lambda x: x[1], reverse=True)),
+        'total_annotations': sum(classes.values()),
+        'annotations_classes': dict(sorted(classes.items(), key=lambda x: (-x[1], x[0]))),
+        'not_utf8_files': encodages,
+        'box_sizes': {
+            'boxes': nb_boxes,
+            'mean_width': math.fsum(sizes[1] for sizes in box_sizes) / nb_boxes if nb_boxes else None,
+            'mean_height': math.fsum(sizes[2] for sizes in box_sizes) / nb_boxes if nb_boxes else None,
+            'min_area': min(min_areas) if min_areas else None,
+            'max_area': max(max_areas) if max_areas else None,
+        },
+    }
+
+
+#Fonction pour enregistrer toutes les statistiques dans un rapport JSON
+def statistics_report(folder, report_path="Statistics/statistics.json", workers=None):
+    statistics = collect_statistics(folder, workers=workers)
+
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    with open(report_path, "w", encoding="utf-8") as resultat_file:
+        json.dump(statistics, resultat_file, ensure_ascii=False, indent=2)
+
+    print(f"{statistics['nb_manuscripts']} manuscrits, {statistics['images']} images")
+    print(f"Le total des annotations est {statistics['total_annotations']}.")
+    print(f"Rapport enregistré dans {report_path}")
+    return statistics
@@ -0,0 +1,186 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+IIIF annotation lists built from the predictions of the model.
+downloading_from_csv_to_manifest.py saves, for each manuscript, its manifest and an image_data.csv file
+with the canvas of every image and its dimensions as declared in the manifest and as downloaded.
+The YOLO prediction files (one .txt file per image, relative coordinates) are read once; the boxes are
+converted to pixels of the downloaded image and then to the coordinate space of the canvas (declared dimensions),
+and an annotation list (IIIF Presentation API 2) is written for each canvas, with a copy of the manifest
+referencing the lists. Each manuscript is processed by a worker of a pool of processes.
+
+    python annotation_lists.py <manuscripts_folder> <predictions_folder> <output_folder> [base_url]
+"""
+
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from label_store import read_label_file
+from Results_from_YOLOv7 import get_class_name
+
+
+PRESENTATION_CONTEXT = 'http://iiif.io/api/presentation/2/context.json'
+
+
+def write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def index_manuscripts(manuscripts_folder):
+    """
+    Reads the image_data.csv file of every manuscript of the folder.
+    Returns {image name without extension: (manuscript name, row of image_data.csv as a dict)}.
+    """
+    images = {}
+    with os.scandir(manuscripts_folder) as entries:
+        manuscripts = sorted(entry.name for entry in entries if entry.is_dir())
+    for manuscript in manuscripts:
+        csv_path = os.path.join(manuscripts_folder, manuscript, 'image_data.csv')
+        if not os.path.exists(csv_path):
+            continue
+        image_data = pd.read_csv(csv_path)
+        for position, row in enumerate(image_data.to_dict('records')):
+            # The images are named <manuscript>_<position in the manifest>.jpg
+            file_name = row.get('imageFileName')
+            if not isinstance(file_name, str) or not file_name:
+                file_name = f'{manuscript}_{position + 1}.jpg'
+            images[os.path.splitext(os.path.basename(file_name))[0]] = (manuscript, row)
+    return images
+
+
+def canvas_scale(row):
+    """
+    Factors converting pixels of the downloaded image to the coordinate space of the canvas:
+    declared dimension / downloaded dimension (1 if the downloaded dimensions are unknown).
+    """
+    declared_width, declared_height = row['imageWidthAsDeclared'], row['imageHeightAsDeclared']
+    downloaded_width, downloaded_height = row.get('imageWidthAsDownloaded'), row.get('imageHeightAsDownloaded')
+    if pd.isna(downloaded_width) or pd.isna(downloaded_height) or not downloaded_width or not downloaded_height:
+        return float(declared_width), float(declared_height), 1.0, 1.0
+    downloaded_width, downloaded_height = float(downloaded_width), float(downloaded_height)
+    return downloaded_width, downloaded_height, float(declared_width) / downloaded_width, float(declared_height) / downloaded_height
+
+
+def canvas_annotations(boxes, row, list_id, min_confidence=0.0):
+    """Annotation list (IIIF Presentation 2) of the boxes (N, 6) predicted on the image of one canvas."""
+    width, height, scale_x, scale_y = canvas_scale(row)
+    resources = []
+    for i, (class_code, x, y, w, h, confidence) in enumerate(boxes.tolist()):
+        # The confidence is NaN when the file has no confidence column
+        has_confidence = not math.isnan(confidence)
+        if has_confidence and confidence < min_confidence:
+            continue
+        # Relative coordinates -> pixels of the downloaded image -> coordinates of the canvas
+        canvas_x = round((x - w / 2) * width * scale_x)
+        canvas_y = round((y - h / 2) * height * scale_y)
+        canvas_w = round(w * width * scale_x)
+        canvas_h = round(h * height * scale_y)
+        label = get_class_name(int(class_code))
+        if has_confidence:
+            label = f'{label} ({confidence:.2f})'
+        resources.append({
+            '@id': f'{list_id}#annotation-{i + 1}',
+            '@type': 'oa:Annotation',
+            'motivation': 'oa:tagging',
+            'resource': {'@type': 'dctypes:Text', 'format': 'text/plain', 'chars': label},
+            'on': f"{row['canvasId']}#xywh={canvas_x},{canvas_y},{canvas_w},{canvas_h}",
+        })
+    return {'@context': PRESENTATION_CONTEXT, '@id': list_id, '@type': 'sc:AnnotationList', 'resources': resources}
+
+
+def manuscript_annotation_lists(manuscripts_folder, manuscript, predictions, output_folder, base_url='',
+                                min_confidence=0.0):
+    """
+    Writes the annotation lists of one manuscript and the annotated copy of its manifest.
+    'predictions' is a list of (prediction file, row of image_data.csv). Returns the number of annotations.
+    """
+    output = os.path.join(output_folder, manuscript)
+    os.makedirs(output, exist_ok=True)
+    base = f"{base_url.rstrip('/')}/{manuscript}" if base_url else manuscript
+
+    lists = {}
+    nb_annotations = 0
+    for prediction_file, row in predictions:
+        name = os.path.splitext(os.path.basename(prediction_file))[0]
+        annotation_list = canvas_annotations(read_label_file(prediction_file), row, f'{base}/{name}.json', min_confidence)
+        write_json(os.path.join(output, name + '.json'), annotation_list)
+        lists[row['canvasId']] = annotation_list['@id']
+        nb_annotations += len(annotation_list['resources'])
+
+    # Copy of the manifest where each canvas references its annotation list
+    manifest_path = os.path.join(manuscripts_folder, manuscript, manuscript + '_manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        for sequence in manifest.get('sequences', []):
+            for canvas in sequence.get('canvases', []):
+                if canvas['@id'] in lists:
+                    other_content = [content for content in canvas.get('otherContent', [])
+                                     if content.get('@id') != lists[canvas['@id']]]
+                    other_content.append({'@id': lists[canvas['@id']], '@type': 'sc:AnnotationList'})
+                    canvas['otherContent'] = other_content
+        write_json(os.path.join(output, manuscript + '_manifest_annotated.json'), manifest)
+    return nb_annotations
+
+
+def _manuscript_job(job):
+    manuscripts_folder, manuscript, predictions, output_folder, base_url, min_confidence = job
+    try:
+        return manuscript, manuscript_annotation_lists(manuscripts_folder, manuscript, predictions, output_folder,
+                                                       base_url, min_confidence), ''
+    except Exception as e:
+        return manuscript, 0, str(e)
+
+
+def annotation_lists(manuscripts_folder, predictions_folder, output_folder, base_url='', min_confidence=0.0,
+                     workers=None):
+    """
+    Writes the annotation lists of all the manuscripts having predictions.
+    The prediction folder is listed once and the files are grouped by manuscript; the manuscripts
+    are processed in parallel. Returns {manuscript: number of annotations}.
+    """
+    images = index_manuscripts(manuscripts_folder)
+
+    grouped = {}
+    unknown = 0
+    with os.scandir(predictions_folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.txt') or not entry.is_file():
+                continue
+            image = images.get(os.path.splitext(entry.name)[0])
+            if image is None:
+                unknown += 1
+                continue
+            manuscript, row = image
+            grouped.setdefault(manuscript, []).append((entry.path, row))
+    if unknown:
+        print(f'{unknown} prediction files without image in the image_data.csv files')
+
+    jobs = [(manuscripts_folder, manuscript, sorted(predictions, key=lambda item: item[0]), output_folder, base_url,
+             min_confidence) for manuscript, predictions in sorted(grouped.items())]
+    counts = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for manuscript, nb_annotations, error in executor.map(_manuscript_job, jobs):
+            if error:
+                print(f'Error while writing the annotations of {manuscript}. Error message: {error}')
+                continue
+            counts[manuscript] = nb_annotations
+
+    print(f'{sum(counts.values())} annotations written for {len(counts)} manuscripts in {output_folder}')
+    return counts
+
+
+if __name__ == '__main__':
+    annotation_lists(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else '')
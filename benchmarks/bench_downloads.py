@@ -0,0 +1,153 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Benchmark of the download scripts against a local IIIF stand-in server (see mock_iiif_server.py),
+so that changes to the download engine can be compared without sending requests to the libraries.
+Both download paths are measured:
+- 'manifests': download_data of downloading_from_csv_to_manifest.py (manifests, then all their images);
+- 'books': download_books of Download_script_for_books_in_miniature.py (miniature and folio of each row).
+For each concurrency (simultaneous connections per server) and request pause, the script reports
+the images per second, the bytes per second, the requests sent again (retries), the failures and the
+median and tail latency (p95, p99) of a download.
+
+    python benchmarks/bench_downloads.py --concurrency 1 2 4 8 --pause 0 0.05 --latency 0.05 --error-rate 0.02
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from download_engine import DownloadEngine, pause_to_rate, set_engine
+from mock_iiif_server import MockIIIFServer
+
+
+class TimedEngine(DownloadEngine):
+    """Download engine recording the duration and the result of every image download."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = []
+        self.timings_lock = threading.Lock()
+
+    def fetch(self, image_url, dir_path):
+        start = time.perf_counter()
+        result = super().fetch(image_url, dir_path)
+        with self.timings_lock:
+            self.timings.append((time.perf_counter() - start, result.nb_bytes, bool(result), result.attempts))
+        return result
+
+
+def run_manifests(server, folder, request_pause, parallel_manuscripts):
+    from downloading_from_csv_to_manifest import download_data
+
+    csv_path = os.path.join(folder, 'manuscripts.csv')
+    pd.DataFrame({
+        'Manifest_URL': [server.manifest_url(manuscript) for manuscript in range(server.nb_manuscripts)],
+        'Image_basename': [f'ms{manuscript}' for manuscript in range(server.nb_manuscripts)],
+    }).to_csv(csv_path, sep=';', index=False)
+    download_data(csv_path, os.path.join(folder, 'manuscripts'), parallel_manuscripts=parallel_manuscripts,
+                  request_pause=request_pause)
+
+
+def run_books(server, folder, request_pause, parallel_manuscripts):
+    from Download_script_for_books_in_miniature import download_books
+
+    rows = []
+    for manuscript in range(server.nb_manuscripts):
+        for canvas in range(server.nb_canvases):
+            folio_url = server.image_url(manuscript, canvas)
+            rows.append({
+                'Image_url': folio_url.replace('/full/full/', '/100,200,300,400/full/'),
+                'Full_image_url': folio_url,
+                'Miniature_filename': f'ms{manuscript}_{canvas + 1}_100,200,300,400',
+                'Folio_filename': f'ms{manuscript}_{canvas + 1}',
+                'Miniature_coordinates': '100,200,300,400',
+            })
+    csv_path = os.path.join(folder, 'books.csv')
+    pd.DataFrame(rows).to_csv(csv_path, sep=';', index=False)
+    download_books(csv_path, os.path.join(folder, 'data'), 'bench')
+
+
+SCRIPTS = {'manifests': run_manifests, 'books': run_books}
+
+
+def bench(server, script, concurrency, request_pause, workers):
+    """Runs one download script with a fresh engine; returns the measures as a dict."""
+    engine = TimedEngine(max_workers=max(workers, concurrency), rate=pause_to_rate(request_pause),
+                         concurrency=concurrency)
+    set_engine(engine)
+    server.reset_statistics()
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        SCRIPTS[script](server, folder, request_pause, parallel_manuscripts=max(1, concurrency))
+        duration = time.perf_counter() - start
+        engine.close()
+    set_engine(None)
+
+    latencies = np.array([timing for timing, _, _, _ in engine.timings])
+    nb_images = sum(1 for _, _, ok, _ in engine.timings if ok)
+    nb_bytes = sum(nb_bytes for _, nb_bytes, ok, _ in engine.timings if ok)
+    return {
+        'script': script,
+        'concurrency': concurrency,
+        'pause': request_pause,
+        'images': nb_images,
+        'failed': len(engine.timings) - nb_images,
+        'seconds': duration,
+        'images/s': nb_images / duration,
+        'MB/s': nb_bytes / duration / 1e6,
+        'requests': server.statistics['requests'],
+        'retries': server.retries(),
+        'image retries': sum(max(0, attempts - 1) for _, _, _, attempts in engine.timings),
+        '429': server.statistics[429],
+        'p50 (s)': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p95 (s)': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        'p99 (s)': float(np.percentile(latencies, 99)) if len(latencies) else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scripts', nargs='+', choices=sorted(SCRIPTS), default=sorted(SCRIPTS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--pause', type=float, nargs='+', default=[0, 0.05], help='request_pause in seconds')
+    parser.add_argument('--workers', type=int, default=8, help='threads of the download engine')
+    parser.add_argument('--manuscripts', type=int, default=4)
+    parser.add_argument('--canvases', type=int, default=20)
+    parser.add_argument('--image-kb', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds before each answer')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second of each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 503 answer')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='probability of a 429 answer')
+    parser.add_argument('--max-rate', type=float, default=None, help='requests per second above which 429 is answered')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of the 429 and 503 answers')
+    parser.add_argument('--output', help='CSV file where the measures are saved')
+    args = parser.parse_args()
+
+    measures = []
+    with MockIIIFServer(args.manuscripts, args.canvases, args.image_kb * 1024, latency=args.latency,
+                        bandwidth=args.bandwidth, error_rate=args.error_rate, rate_429=args.rate_429,
+                        max_rate=args.max_rate, retry_after=args.retry_after) as server:
+        for script in args.scripts:
+            for request_pause in args.pause:
+                for concurrency in args.concurrency:
+                    measures.append(bench(server, script, concurrency, request_pause, args.workers))
+                    print(measures[-1])
+
+    table = pd.DataFrame(measures)
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.3f}'.format):
+        print(table)
+    if args.output:
+        table.to_csv(args.output, index=False)
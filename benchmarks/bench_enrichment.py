@@ -0,0 +1,102 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Benchmark of the Books_in_Books enrichment: the previous row by row loop (one .loc scan of
+books_csv per column and per row of the Horae export) against enrich_books_csv (one merge).
+Synthetic CSVs are generated, so the script can be run anywhere:
+
+    python benchmarks/bench_enrichment.py --rows 1000 5000 20000
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Download_script_for_books_in_miniature import ENRICHED_COLUMNS, enrich_books_csv
+
+
+def enrich_books_csv_loop(books_csv, horae_csv):
+    """The previous implementation, kept here as the reference."""
+    books_csv = books_csv.copy()
+    books_urls = list(books_csv['Image_url'])
+
+    for _, row in horae_csv.iterrows():
+        horae_url = row['image_URL']
+        horae_ms_name = row['rec_Title_full']
+        horae_manifest = row['iiif manifest']
+        horae_iiif_nb = row['image # in iiif manifest']
+
+        basename = re.sub(r"[^\w]+", "_", horae_ms_name)
+        box_coordinates = re.search(r"\d+,\d+,\d+,\d+", horae_url).group()
+        full_image_url = re.sub(r"\d+,\d+,\d+,\d+", "full", horae_url)
+
+        if horae_url in books_urls:
+            books_csv.loc[books_csv['Image_url'] == horae_url, 'Full_image_url'] = full_image_url
+            books_csv.loc[books_csv['Image_url'] == horae_url, 'Manifest_URL'] = horae_manifest
+            books_csv.loc[books_csv['Image_url'] == horae_url, 'Image_basename'] = basename
+            books_csv.loc[books_csv['Image_url'] == horae_url, 'Image_#_in_manifest'] = horae_iiif_nb
+            books_csv.loc[books_csv['Image_url'] == horae_url, 'Folio_filename'] = f"{basename}_{horae_iiif_nb}"
+            books_csv.loc[books_csv['Image_url'] == horae_url, 'Miniature_coordinates'] = box_coordinates
+            books_csv.loc[books_csv['Image_url'] == horae_url, 'Miniature_filename'] = f"{basename}_{horae_iiif_nb}_{box_coordinates}"
+
+    return books_csv
+
+
+def synthetic_csvs(nb_rows, match_ratio=0.5):
+    """Builds a Horae export of 'nb_rows' rows and a books_csv sharing about 'match_ratio' of its URLs."""
+    horae_rows = []
+    for i in range(nb_rows):
+        ms = i // 20
+        horae_rows.append({
+            'image_URL': f'https://iiif.example.org/iiif/ms{ms}/f{i}/{i % 500},{i % 300},{200 + i % 50},{300 + i % 70}/full/0/default.jpg',
+            'rec_Title_full': f'Paris, Bibliothèque nationale, Latin {ms}',
+            'iiif manifest': f'https://iiif.example.org/iiif/ms{ms}/manifest.json',
+            'image # in iiif manifest': i % 200 + 1,
+        })
+    horae_csv = pd.DataFrame(horae_rows)
+    nb_matched = int(nb_rows * match_ratio)
+    books_urls = list(horae_csv['image_URL'][:nb_matched]) + [
+        f'https://other.example.org/iiif/{i}/0,0,10,10/full/0/default.jpg' for i in range(nb_rows - nb_matched)]
+    books_csv = pd.DataFrame({'Image_url': books_urls, 'Book': range(nb_rows)})
+    return books_csv, horae_csv
+
+
+def bench(nb_rows, skip_loop_above):
+    books_csv, horae_csv = synthetic_csvs(nb_rows)
+
+    start = time.perf_counter()
+    vectorized = enrich_books_csv(books_csv, horae_csv)
+    vectorized_time = time.perf_counter() - start
+
+    if nb_rows > skip_loop_above:
+        print(f'{nb_rows:>8} rows | loop: skipped | merge: {vectorized_time:8.3f} s')
+        return
+
+    start = time.perf_counter()
+    reference = enrich_books_csv_loop(books_csv, horae_csv)
+    loop_time = time.perf_counter() - start
+
+    # Both implementations must give the same table
+    pd.testing.assert_frame_equal(vectorized[ENRICHED_COLUMNS].astype(str), reference[ENRICHED_COLUMNS].astype(str))
+    print(f'{nb_rows:>8} rows | loop: {loop_time:8.3f} s | merge: {vectorized_time:8.3f} s | x{loop_time / vectorized_time:.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--skip-loop-above', type=int, default=20000,
+                        help='do not run the (slow) loop for larger tables')
+    args = parser.parse_args()
+
+    for nb_rows in args.rows:
+        bench(nb_rows, args.skip_loop_above)
@@ -0,0 +1,197 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Local stand-in for a IIIF server, to measure the download scripts without sending requests to the libraries.
+It serves synthetic manifests (IIIF Presentation 2), info.json files and images (JPEG headers followed by
+random bytes: the dimensions can be read, the pixels cannot be decoded), with a configurable latency,
+bandwidth, rate of server errors and of '429 Too Many Requests' answers (with a Retry-After header).
+
+    server = MockIIIFServer(nb_manuscripts=4, nb_canvases=20, latency=0.05, error_rate=0.02).start()
+    ... server.manifest_url(0) ...
+    server.stop()
+"""
+
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def synthetic_jpeg(width, height, nb_bytes, seed=0):
+    """JPEG start of image and frame header (SOF0) with the given dimensions, padded to nb_bytes."""
+    header = (b'\xff\xd8'
+              + b'\xff\xc0' + (17).to_bytes(2, 'big') + b'\x08' + height.to_bytes(2, 'big') + width.to_bytes(2, 'big')
+              + b'\x03\x01\x22\x00\x02\x11\x01\x03\x11\x01')
+    padding = random.Random(seed).randbytes(max(0, nb_bytes - len(header) - 2))
+    return header + padding + b'\xff\xd9'
+
+
+class MockIIIFServer:
+    """
+    'latency': seconds before each answer; 'bandwidth': bytes per second of each response (None: unlimited);
+    'error_rate': probability of a '503 Service Unavailable'; 'rate_429': probability of a '429' answer,
+    and 'max_rate': requests per second above which every request gets a '429' (None: no limit).
+    The 429 and 503 answers carry a 'Retry-After: retry_after' header.
+    """
+
+    def __init__(self, nb_manuscripts=4, nb_canvases=20, image_bytes=200 * 1024, image_size=(2000, 3000),
+                 latency=0.0, bandwidth=None, error_rate=0.0, rate_429=0.0, max_rate=None, retry_after=1, seed=0):
+        self.nb_manuscripts = nb_manuscripts
+        self.nb_canvases = nb_canvases
+        self.image_size = image_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.max_rate = max_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.image = synthetic_jpeg(image_size[0], image_size[1], image_bytes, seed)
+        self.lock = threading.Lock()
+        self.statistics = Counter()
+        self.requests_per_path = Counter()
+        self.window = []
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def manifest_url(self, manuscript):
+        return f'{self.url}/iiif/ms{manuscript}/manifest.json'
+
+    def image_url(self, manuscript, canvas):
+        return f'{self.url}/iiif/ms{manuscript}/f{canvas}/full/full/0/default.jpg'
+
+    def manifest(self, manuscript):
+        width, height = self.image_size
+        canvases = []
+        for canvas in range(self.nb_canvases):
+            service = f'{self.url}/iiif/ms{manuscript}/f{canvas}'
+            canvases.append({
+                '@id': f'{self.url}/iiif/ms{manuscript}/canvas/{canvas}',
+                '@type': 'sc:Canvas',
+                'label': f'f. {canvas + 1}',
+                'width': width,
+                'height': height,
+                'images': [{'@type': 'oa:Annotation', 'motivation': 'sc:painting', 'resource': {
+                    '@id': self.image_url(manuscript, canvas), '@type': 'dctypes:Image', 'format': 'image/jpeg',
+                    'width': width, 'height': height,
+                    'service': {'@context': 'http://iiif.io/api/image/2/context.json', '@id': service,
+                                'profile': 'http://iiif.io/api/image/2/level1.json'}}}],
+            })
+        return {'@context': 'http://iiif.io/api/presentation/2/context.json', '@id': self.manifest_url(manuscript),
+                '@type': 'sc:Manifest', 'label': f'Manuscript {manuscript}',
+                'sequences': [{'@type': 'sc:Sequence', 'canvases': canvases}]}
+
+    def info(self, service):
+        width, height = self.image_size
+        return {'@context': 'http://iiif.io/api/image/2/context.json', '@id': f'{self.url}{service}',
+                'protocol': 'http://iiif.io/api/image', 'width': width, 'height': height,
+                'profile': ['http://iiif.io/api/image/2/level1.json']}
+
+    def _fault(self):
+        """Status code of a simulated fault for the next request, or None."""
+        with self.lock:
+            now = time.monotonic()
+            self.window = [t for t in self.window if now - t < 1.0]
+            self.window.append(now)
+            if self.max_rate is not None and len(self.window) > self.max_rate:
+                return 429
+            draw = self.random.random()
+        if draw < self.rate_429:
+            return 429
+        if draw < self.rate_429 + self.error_rate:
+            return 503
+        return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b'', content_type='application/json', headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if server.bandwidth:
+                    chunk_size = max(1, int(server.bandwidth / 20))
+                    for i in range(0, len(body), chunk_size):
+                        self.wfile.write(body[i:i + chunk_size])
+                        time.sleep(len(body[i:i + chunk_size]) / server.bandwidth)
+                else:
+                    self.wfile.write(body)
+                with server.lock:
+                    server.statistics[status] += 1
+                    server.statistics['bytes'] += len(body)
+
+            def do_GET(self):
+                with server.lock:
+                    server.statistics['requests'] += 1
+                    server.requests_per_path[self.path] += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                fault = server._fault()
+                if fault is not None:
+                    self._send(fault, b'', 'text/plain', {'Retry-After': str(server.retry_after)})
+                    return
+
+                parts = self.path.strip('/').split('/')
+                try:
+                    if len(parts) == 3 and parts[2] == 'manifest.json':
+                        body = json.dumps(server.manifest(int(parts[1][2:]))).encode('utf-8')
+                        self._send(200, body)
+                    elif len(parts) == 4 and parts[3] == 'info.json':
+                        self._send(200, json.dumps(server.info('/' + '/'.join(parts[:3]))).encode('utf-8'))
+                    elif len(parts) == 7 and parts[0] == 'iiif':
+                        self._send(200, server.image, 'image/jpeg')
+                    else:
+                        self._send(404, b'', 'text/plain')
+                except ValueError:
+                    self._send(404, b'', 'text/plain')
+
+        return Handler
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def reset_statistics(self):
+        with self.lock:
+            self.statistics = Counter()
+            self.requests_per_path = Counter()
+            self.window = []
+
+    def retries(self):
+        """Number of requests sent again for a path already requested."""
+        with self.lock:
+            return sum(count - 1 for count in self.requests_per_path.values())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,157 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Box geometry and class balance of an annotated dataset, to choose the anchors and the input size of the model.
+The annotation files are found as in Statistics_scipts_for_annotated_data.py (one .txt file per image),
+all the boxes are read from the label store of the folder (see label_store.py) and the distributions
+are computed on the whole arrays:
+width, height, aspect ratio and area per class (histograms and quantiles), number of objects per image,
+number of objects of each class per manuscript, and optionally k-means clustering of the anchors.
+
+    python box_analytics.py <folder> [report.json]
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from Statistics_scipts_for_annotated_data import IDNO, get_annotation_files
+from label_store import build_label_store
+
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def load_boxes(folder):
+    """
+    Loads all the boxes of the folder.
+    Returns (boxes, image_index, image_names): boxes is a (N, 6) array (class, x, y, w, h, confidence),
+    image_index gives for each box the position of its image in image_names.
+    """
+    annotation_files = get_annotation_files(folder)
+    # The boxes are read from the label store of the folder (only the modified label files are read again)
+    store = build_label_store(folder)
+    arrays = [np.asarray(store.boxes_of(annotation_file)) for annotation_file in annotation_files]
+    counts = np.array([len(array) for array in arrays], dtype=np.int64)
+    boxes = np.concatenate(arrays) if arrays else np.zeros((0, 6), dtype=np.float32)
+    image_index = np.repeat(np.arange(len(annotation_files)), counts)
+    return boxes, image_index, annotation_files
+
+
+def distribution(values, bins=20, value_range=None):
+    """Histogram and quantiles of a 1D array."""
+    if len(values) == 0:
+        return {'count': 0}
+    counts, edges = np.histogram(values, bins=bins, range=value_range)
+    return {
+        'count': int(len(values)),
+        'mean': float(values.mean()),
+        'quantiles': {str(q): float(v) for q, v in zip(QUANTILES, np.quantile(values, QUANTILES))},
+        'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()},
+    }
+
+
+def geometry(boxes, bins=20):
+    """
+    Distributions of the width, height, aspect ratio and area of the boxes (relative coordinates).
+    The aspect ratio is given as log2(w/h), so that 2:1 and 1:2 boxes are symmetric around 0.
+    """
+    widths = boxes[:, 3].astype(np.float64)
+    heights = boxes[:, 4].astype(np.float64)
+    valid = (widths > 0) & (heights > 0)
+    return {
+        'width': distribution(widths, bins, (0, 1)),
+        'height': distribution(heights, bins, (0, 1)),
+        'log2_aspect_ratio': distribution(np.log2(widths[valid] / heights[valid]), bins),
+        'area': distribution(widths * heights, bins, (0, 1)),
+    }
+
+
+def kmeans_anchors(wh, k=9, iterations=300, max_samples=200000, seed=0):
+    """
+    k-means clustering of the (width, height) of the boxes with the distance 1 - IoU, as for the YOLO anchors.
+    At most 'max_samples' boxes are used (random sample). Returns the anchors sorted by area and the mean best IoU.
+    """
+    rng = np.random.default_rng(seed)
+    wh = wh[(wh > 0).all(axis=1)]
+    if len(wh) > max_samples:
+        wh = wh[rng.choice(len(wh), max_samples, replace=False)]
+    if len(wh) < k:
+        return wh, None
+
+    def iou(boxes, anchors):
+        intersection = np.minimum(boxes[:, None, :], anchors[None, :, :]).prod(axis=2)
+        return intersection / (boxes.prod(axis=1)[:, None] + anchors.prod(axis=1)[None, :] - intersection)
+
+    anchors = wh[rng.choice(len(wh), k, replace=False)]
+    assignment = None
+    for _ in range(iterations):
+        new_assignment = iou(wh, anchors).argmax(axis=1)
+        if assignment is not None and (new_assignment == assignment).all():
+            break
+        assignment = new_assignment
+        for cluster in range(k):
+            members = wh[assignment == cluster]
+            if len(members):
+                anchors[cluster] = np.median(members, axis=0)
+
+    anchors = anchors[np.argsort(anchors.prod(axis=1))]
+    return anchors, float(iou(wh, anchors).max(axis=1).mean())
+
+
+def analyse(folder, bins=20, anchors=0, img_size=640):
+    """
+    Computes all the analytics of the folder. With anchors > 0, also computes 'anchors' k-means anchors,
+    given in pixels for an input size of img_size.
+    """
+    boxes, image_index, annotation_files = load_boxes(folder)
+    classes = boxes[:, 0].astype(np.int64)
+
+    report = {'folder': folder, 'images': len(annotation_files), 'boxes': int(len(boxes))}
+    report['all_classes'] = geometry(boxes, bins)
+    report['per_class'] = {str(class_code): geometry(boxes[classes == class_code], bins)
+                           for class_code in np.unique(classes)}
+
+    objects_per_image = np.bincount(image_index, minlength=len(annotation_files))
+    report['objects_per_image'] = distribution(objects_per_image.astype(np.float64),
+                                               bins=max(1, int(objects_per_image.max(initial=0)) + 1),
+                                               value_range=(0, int(objects_per_image.max(initial=0)) + 1))
+
+    # Number of objects of each class per manuscript (name of the image without its number)
+    manuscripts = []
+    for annotation_file in annotation_files:
+        match = IDNO.match(os.path.splitext(annotation_file)[0] + '.jpg')
+        manuscripts.append(match.group(1) if match else os.path.splitext(annotation_file)[0])
+    manuscript_names, image_manuscript = np.unique(np.array(manuscripts, dtype=str), return_inverse=True)
+    class_codes = np.unique(classes)
+    if len(boxes):
+        box_manuscript = image_manuscript[image_index]
+        class_position = np.searchsorted(class_codes, classes)
+        balance = np.zeros((len(manuscript_names), len(class_codes)), dtype=np.int64)
+        np.add.at(balance, (box_manuscript, class_position), 1)
+        report['class_balance_per_manuscript'] = {
+            str(name): {str(code): int(count) for code, count in zip(class_codes, row)}
+            for name, row in zip(manuscript_names, balance)
+        }
+
+    if anchors:
+        wh = boxes[:, 3:5].astype(np.float64) * img_size
+        found, mean_iou = kmeans_anchors(wh, k=anchors)
+        report['anchors'] = {'img_size': img_size, 'anchors': np.round(found).astype(int).tolist(), 'mean_best_iou': mean_iou}
+
+    return report
+
+
+if __name__ == '__main__':
+    report = analyse(sys.argv[1], anchors=9)
+    output = sys.argv[2] if len(sys.argv) > 2 else os.path.join('Statistics', 'box_analytics.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"{report['boxes']} boîtes analysées, rapport enregistré dans {output}")
@@ -0,0 +1,129 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Checkpointing of row by row results.
+Instead of rewriting a whole CSV file after each row, the results are appended to a JSON Lines log,
+which is flushed to disk every 'flush_every' rows or 'flush_interval' seconds. The cost of a flush only
+depends on the number of new rows. At the end of the run, the final table is rebuilt from the log
+and written once, through a temporary file and an atomic rename.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+
+def atomic_write_csv(df, path, **to_csv_kwargs):
+    """Writes a DataFrame to 'path' through a temporary file, so that 'path' is never half written."""
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+            df.to_csv(f, **to_csv_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class CheckpointLog:
+    """
+    Append-only log of results, one JSON object per line, identified by 'key_column'.
+    When a key appears several times, the last record wins.
+    """
+
+    def __init__(self, log_path, key_column, flush_every=100, flush_interval=30):
+        self.log_path = log_path
+        self.key_column = key_column
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.records = self._read()
+
+    def _read(self):
+        records = {}
+        if not os.path.exists(self.log_path):
+            return records
+        valid_size = 0
+        with open(self.log_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    # Last line cut by an interruption
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                records[record[self.key_column]] = record
+                valid_size += len(line)
+        # Remove the cut line, so that new records are not appended to it
+        if valid_size != os.path.getsize(self.log_path):
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(valid_size)
+        return records
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, record):
+        """Adds the result of one row; the log is flushed when enough rows or time have passed."""
+        self.records[record[self.key_column]] = record
+        self.buffer.append(record)
+        if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                for record in self.buffer:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def rebuild(self, df):
+        """
+        Returns a copy of 'df' updated with the logged results, joined on 'key_column'.
+        Columns of the log missing from 'df' are added.
+        """
+        self.flush()
+        if not self.records:
+            return df.copy()
+        results = pd.DataFrame(list(self.records.values())).set_index(self.key_column)
+        rebuilt = df.copy()
+        keys = rebuilt[self.key_column]
+        for column in results.columns:
+            values = keys.map(results[column])
+            if column in rebuilt.columns:
+                # A value missing from the log (NaN) does not erase the value already in the table
+                rebuilt[column] = values.where(values.notna(), rebuilt[column])
+            else:
+                rebuilt[column] = values
+        return rebuilt
+
+    def remove(self):
+        """Deletes the log once the final table has been written."""
+        self.buffer = []
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
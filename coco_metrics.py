@@ -0,0 +1,241 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+COCO-style metrics for the YOLOv7 results, computed in one pass.
+For each image and each class, the IoU matrix between annotations and predictions is computed once,
+and the matching is then done for every IoU threshold (0.50, 0.55, ..., 0.95) from this matrix.
+The precision/recall curves are built from the confidences of the predictions, so every confidence
+cut-off is evaluated at the same time. The script gives, per class, the precision/recall curve,
+the AP@.5 and the AP@[.5:.95], and the mAP@.5 and mAP@[.5:.95] over the classes.
+evaluate_with_results also derives, from the same matching, the table of the TP/FP/FN of every box
+written by Results_from_YOLOv7.py, so the labels are read and matched only once.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from label_store import LabelStore
+from Results_from_YOLOv7 import (RESULT_COLUMNS, append_result_rows, assign_greedy, get_class_name, iou_matrix,
+                                 open_label_stores, prediction_order, store_boxes)
+
+
+IOU_THRESHOLDS = np.round(np.arange(0.5, 0.951, 0.05), 2)
+# 101 recall points, as in the COCO evaluation
+RECALL_POINTS = np.linspace(0, 1, 101)
+
+
+def image_statistics(annotations, predictions, iou_thresholds=IOU_THRESHOLDS, results_threshold=None, matches=None):
+    """
+    For one image (boxes (N, 6) of the annotations and of the predictions), returns {class: (confidences, tp,
+    nb_annotations)} where 'tp' is a boolean array (nb_predictions, nb_thresholds): tp[j, t] is True if
+    prediction j is a true positive at threshold t.
+    If 'matches' is a list, the pairs (annotation index, prediction index, IoU) matched at 'results_threshold'
+    are appended to it, from the same IoU matrices (as Results_from_YOLOv7.match_box_arrays would match them).
+    """
+    if matches is not None:
+        # Position of the results threshold among the IoU thresholds (None: matched separately)
+        close = np.flatnonzero(np.isclose(iou_thresholds, results_threshold))
+        results_t = int(close[0]) if len(close) else None
+
+    statistics = {}
+    for class_code in np.union1d(annotations[:, 0], predictions[:, 0]):
+        ann_idx = np.flatnonzero(annotations[:, 0] == class_code)
+        pred_idx = np.flatnonzero(predictions[:, 0] == class_code)
+        class_annotations = annotations[ann_idx]
+        class_predictions = predictions[pred_idx]
+        if class_predictions.shape[1] >= 6:
+            confidences = np.nan_to_num(class_predictions[:, 5], nan=1.0)
+        else:
+            confidences = np.ones(len(class_predictions))
+
+        tp = np.zeros((len(class_predictions), len(iou_thresholds)), dtype=bool)
+        if len(class_annotations) and len(class_predictions):
+            # The IoU matrix is computed once and used for every threshold
+            ious = iou_matrix(class_annotations, class_predictions)
+            order = prediction_order(class_predictions)
+            for t, threshold in enumerate(iou_thresholds):
+                pairs = assign_greedy(ious, order, threshold)
+                for _, j in pairs:
+                    tp[j, t] = True
+                if matches is not None and t == results_t:
+                    matches.extend((int(ann_idx[i]), int(pred_idx[j]), float(ious[i, j])) for i, j in pairs)
+            if matches is not None and results_t is None:
+                matches.extend((int(ann_idx[i]), int(pred_idx[j]), float(ious[i, j]))
+                               for i, j in assign_greedy(ious, order, results_threshold))
+        statistics[int(class_code)] = (confidences, tp, len(class_annotations))
+    return statistics
+
+
+def merge_statistics(total, statistics):
+    for class_code, (confidences, tp, nb_annotations) in statistics.items():
+        if class_code not in total:
+            total[class_code] = ([], [], 0)
+        all_confidences, all_tp, all_annotations = total[class_code]
+        all_confidences.append(confidences)
+        all_tp.append(tp)
+        total[class_code] = (all_confidences, all_tp, all_annotations + nb_annotations)
+
+
+def shard_statistics(ann_store_dir, pred_store_dir, names, iou_thresholds=IOU_THRESHOLDS, results_threshold=None):
+    """
+    Statistics of a list of label files, read from the label stores; run in a worker process.
+    Returns (statistics, columns): with 'results_threshold', 'columns' holds the TP/FP/FN rows of the boxes
+    at this threshold (columns of Results_from_YOLOv7.RESULT_COLUMNS), otherwise it is None.
+    """
+    ann_store = LabelStore(ann_store_dir) if ann_store_dir else None
+    pred_store = LabelStore(pred_store_dir) if pred_store_dir else None
+    columns = {column: [] for column in RESULT_COLUMNS} if results_threshold is not None else None
+    total = {}
+    for name in names:
+        annotations, predictions = store_boxes(ann_store, name), store_boxes(pred_store, name)
+        matches = [] if columns is not None else None
+        merge_statistics(total, image_statistics(annotations, predictions, iou_thresholds, results_threshold, matches))
+        if columns is not None:
+            matched_annotations = {i for i, _, _ in matches}
+            matched_predictions = {j for _, j, _ in matches}
+            false_positives = [j for j in range(len(predictions)) if j not in matched_predictions]
+            false_negatives = [i for i in range(len(annotations)) if i not in matched_annotations]
+            append_result_rows(columns, name, annotations, predictions, matches, false_positives, false_negatives)
+    statistics = {class_code: (np.concatenate(confidences), np.concatenate(tp), nb_annotations)
+                  for class_code, (confidences, tp, nb_annotations) in total.items()}
+    return statistics, columns
+
+
+def precision_recall(confidences, tp, nb_annotations):
+    """
+    Precision and recall after each prediction, the predictions being sorted by decreasing confidence.
+    Returns (sorted confidences, precision, recall), precision and recall having one column per IoU threshold.
+    """
+    order = np.argsort(-confidences, kind='stable')
+    tp = tp[order]
+    tp_cumsum = np.cumsum(tp, axis=0)
+    fp_cumsum = np.cumsum(~tp, axis=0)
+    precision = tp_cumsum / np.maximum(tp_cumsum + fp_cumsum, 1)
+    recall = tp_cumsum / max(nb_annotations, 1)
+    return confidences[order], precision, recall
+
+
+def average_precision(precision, recall):
+    """AP for each IoU threshold (column), interpolated on 101 recall points as in COCO."""
+    if len(precision) == 0:
+        return np.zeros(precision.shape[1])
+    # Interpolated precision: the best precision at an equal or higher recall
+    interpolated = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+    ap = np.zeros(precision.shape[1])
+    for t in range(precision.shape[1]):
+        indices = np.searchsorted(recall[:, t], RECALL_POINTS, side='left')
+        values = np.where(indices < len(recall), interpolated[np.minimum(indices, len(recall) - 1), t], 0.0)
+        ap[t] = values.mean()
+    return ap
+
+
+def evaluate(ann_dir, pred_dir, iou_thresholds=IOU_THRESHOLDS, workers=None, shard_size=256):
+    """
+    Computes the metrics for all the images of ann_dir and pred_dir.
+    Returns (metrics, curves): 'metrics' is a dictionary with the mAP and the AP per class,
+    'curves' a DataFrame with the precision/recall curve of each class at IoU 0.5.
+    """
+    metrics, curves, _ = evaluate_with_results(ann_dir, pred_dir, None, iou_thresholds, workers, shard_size)
+    return metrics, curves
+
+
+def evaluate_with_results(ann_dir, pred_dir, threshold=0.5, iou_thresholds=IOU_THRESHOLDS, workers=None,
+                          shard_size=256):
+    """
+    Computes the metrics and, from the same matching, the table of the TP/FP/FN of every box at the IoU
+    'threshold' (the table of Results_from_YOLOv7.evaluate_directories, greedy matching): the label files
+    are read and the boxes matched only once. Returns (metrics, curves, results); results is None if
+    'threshold' is None.
+    """
+    # The boxes are read from the label stores of the two folders (see label_store.py)
+    ann_store, pred_store, names = open_label_stores(ann_dir, pred_dir)
+    store_dirs = tuple(store.store_dir if store is not None else None for store in (ann_store, pred_store))
+    shards = [names[i:i + shard_size] for i in range(0, len(names), shard_size)]
+
+    total = {}
+    columns = {column: [] for column in RESULT_COLUMNS}
+
+    def merge(result):
+        statistics, shard_columns = result
+        merge_statistics(total, statistics)
+        if shard_columns is not None:
+            for column in RESULT_COLUMNS:
+                columns[column].extend(shard_columns[column])
+
+    if workers == 1 or len(shards) <= 1:
+        for shard in shards:
+            merge(shard_statistics(*store_dirs, shard, iou_thresholds, threshold))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(shard_statistics, *store_dirs, shard, iou_thresholds, threshold)
+                       for shard in shards]
+            # The shards are merged in order, so the results do not depend on the number of processes
+            for future in futures:
+                merge(future.result())
+
+    iou_50 = int(np.argmin(np.abs(iou_thresholds - 0.5)))
+    per_class = {}
+    curves = []
+    for class_code in sorted(total):
+        confidences, tp, nb_annotations = total[class_code]
+        confidences = np.concatenate(confidences)
+        tp = np.concatenate(tp)
+        # A class without annotation has no AP (only false positives)
+        if nb_annotations == 0:
+            per_class[get_class_name(class_code)] = {'annotations': 0, 'predictions': int(len(tp)),
+                                                     'AP@.5': None, 'AP@[.5:.95]': None}
+            continue
+
+        sorted_confidences, precision, recall = precision_recall(confidences, tp, nb_annotations)
+        ap = average_precision(precision, recall)
+        per_class[get_class_name(class_code)] = {
+            'annotations': int(nb_annotations),
+            'predictions': int(len(tp)),
+            'AP@.5': float(ap[iou_50]),
+            'AP@[.5:.95]': float(ap.mean()),
+            'AP_per_threshold': {f'{threshold:.2f}': float(value) for threshold, value in zip(iou_thresholds, ap)},
+        }
+        curves.append(pd.DataFrame({
+            'classe': get_class_name(class_code),
+            'confidence': sorted_confidences,
+            'precision': precision[:, iou_50],
+            'recall': recall[:, iou_50],
+        }))
+
+    evaluated = [values for values in per_class.values() if values['AP@.5'] is not None]
+    metrics = {
+        'images': len(names),
+        'iou_thresholds': [float(threshold) for threshold in iou_thresholds],
+        'mAP@.5': float(np.mean([values['AP@.5'] for values in evaluated])) if evaluated else None,
+        'mAP@[.5:.95]': float(np.mean([values['AP@[.5:.95]'] for values in evaluated])) if evaluated else None,
+        'classes': per_class,
+    }
+    curves = pd.concat(curves, ignore_index=True) if curves else pd.DataFrame(columns=['classe', 'confidence', 'precision', 'recall'])
+    results = None
+    if threshold is not None:
+        results = pd.DataFrame(columns, columns=RESULT_COLUMNS)
+        results['IoU'] = results['IoU'].astype('float64')
+    return metrics, curves, results
+
+
+if __name__ == '__main__':
+    directory_results = ''
+    img_ann_dir = os.path.join(directory_results, 'labels_ann')
+    img_pred_dir = os.path.join(directory_results, 'labels_pred')
+
+    metrics, curves = evaluate(img_ann_dir, img_pred_dir)
+
+    with open(os.path.join(directory_results, 'metrics.json'), 'w') as f:
+        json.dump(metrics, f, indent=2)
+    curves.to_csv(os.path.join(directory_results, 'precision_recall_curves.csv'), index=False)
+
+    print(f"mAP@.5 : {metrics['mAP@.5']}")
+    print(f"mAP@[.5:.95] : {metrics['mAP@[.5:.95]']}")
@@ -0,0 +1,312 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Index of the downloaded images, to find duplicates.
+The same folio can be reached through several manifests or rows of the csv files. For every image, the index
+stores the SHA-256 of its content, a perceptual hash (pHash: DCT of the image reduced to 32 x 32 grey pixels,
+64 bits) and the URLs it was downloaded from. The download engine uses it to skip a URL already downloaded
+and to link an image whose content is already on disk instead of keeping a second copy.
+The near-duplicate clusters (images whose perceptual hashes differ by a few bits: same folio at another
+resolution or recompressed) are written in a report, so that the split keeps them in the same set.
+
+    python dedup_index.py <folder> [report.json] [max_distance]
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff')
+HASH_SIZE = 8
+DCT_SIZE = 32
+# The 64 bits of the pHash are cut into 8 bands of 8 bits: two hashes at a distance of 7 bits or less
+# have at least one identical band, so only the images sharing a band are compared
+NB_BANDS = 8
+DEFAULT_MAX_DISTANCE = 6
+# Largest near-duplicate cluster: the copies of one folio are a handful of images, while blank folios or
+# bindings of different manuscripts would otherwise gather into large clusters
+DEFAULT_MAX_CLUSTER_SIZE = 16
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(DCT_SIZE)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def perceptual_hash(path):
+    """64-bit pHash of an image (as a signed integer, to be stored by SQLite), and its (width, height)."""
+    with Image.open(path) as img:
+        size = img.size
+        # A JPEG is decoded directly at a reduced scale
+        img.draft('L', (DCT_SIZE * 2, DCT_SIZE * 2))
+        pixels = np.asarray(img.convert('L').resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    coefficients = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    # The first coefficient (mean brightness) is left out of the median
+    bits = coefficients > np.median(coefficients[1:])
+    value = int(''.join('1' if bit else '0' for bit in bits), 2)
+    return value - (1 << 64) if value >= 1 << 63 else value, size
+
+
+def hamming_distance(hash1, hash2):
+    return bin((hash1 ^ hash2) & ((1 << 64) - 1)).count('1')
+
+
+def image_hashes(path):
+    """(sha256, phash, width, height) of an image file; the pHash is None if the image cannot be decoded."""
+    sha256 = file_sha256(path)
+    try:
+        phash, (width, height) = perceptual_hash(path)
+    except Exception:
+        phash, width, height = None, None, None
+    return sha256, phash, width, height
+
+
+def link_or_copy(src, dst):
+    """Puts a hardlink to src at dst (a copy if the link cannot be created), replacing dst atomically."""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+class DedupIndex:
+    """Index stored in the SQLite file 'db_path'; can be shared by the threads of the download engine."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            'path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, sha256 TEXT, phash INTEGER, '
+            'width INTEGER, height INTEGER)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT, path TEXT)')
+
+    def _is_current(self, path, mtime_ns, size):
+        """True if the file at 'path' has not changed since it was indexed."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) == (mtime_ns, size)
+
+    def find_url(self, url):
+        """Path of an indexed image downloaded from 'url' which is still on disk and unchanged, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT images.path, images.mtime_ns, images.size FROM urls JOIN images '
+                'ON urls.path = images.path AND urls.sha256 = images.sha256 WHERE urls.url = ?', (url,)).fetchone()
+        if row is not None and self._is_current(*row):
+            return row[0]
+        return None
+
+    def find_sha256(self, sha256, exclude=None):
+        """Path of an indexed image with this content (other than 'exclude'), still on disk and unchanged, or None."""
+        with self.lock:
+            rows = self.connection.execute('SELECT path, mtime_ns, size FROM images WHERE sha256 = ?', (sha256,)).fetchall()
+        for row in rows:
+            if row[0] != exclude and self._is_current(*row):
+                return row[0]
+        return None
+
+    def image(self, path):
+        """Indexed values {sha256, phash, width, height} of an image, or None."""
+        with self.lock:
+            row = self.connection.execute('SELECT sha256, phash, width, height FROM images WHERE path = ?',
+                                          (path,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('sha256', 'phash', 'width', 'height'), row))
+
+    def _insert(self, path, stat, sha256, phash, width, height):
+        self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (path, stat.st_mtime_ns, stat.st_size, sha256, phash, width, height))
+
+    def add(self, url, path, sha256=None):
+        """Indexes an image just downloaded from 'url' (the SHA-256 is computed if not given)."""
+        if sha256 is None:
+            sha256 = file_sha256(path)
+        try:
+            phash, (width, height) = perceptual_hash(path)
+        except Exception:
+            phash, width, height = None, None, None
+        stat = os.stat(path)
+        with self.lock:
+            self._insert(path, stat, sha256, phash, width, height)
+            if url is not None:
+                self.connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)', (url, sha256, path))
+
+    def scan(self, folder, workers=None, parallel_above=64):
+        """
+        Indexes all the images of 'folder' and its subfolders: only the images added or modified since
+        the last scan are read, and the images removed from the folder are removed from the index.
+        Returns the number of images read.
+        """
+        files = {}
+        for root, dirs, names in os.walk(folder):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            for name in names:
+                if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('.'):
+                    path = os.path.join(root, name)
+                    files[path] = os.stat(path)
+
+        prefix = os.path.join(folder, '')
+        with self.lock:
+            known = {path: (mtime_ns, size) for path, mtime_ns, size
+                     in self.connection.execute('SELECT path, mtime_ns, size FROM images')
+                     if path.startswith(prefix)}
+        changed = [path for path, stat in files.items() if known.get(path) != (stat.st_mtime_ns, stat.st_size)]
+        removed = [path for path in known if path not in files]
+
+        if len(changed) > parallel_above and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                all_hashes = list(executor.map(image_hashes, changed, chunksize=32))
+        else:
+            all_hashes = [image_hashes(path) for path in changed]
+
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('DELETE FROM images WHERE path = ?', [(path,) for path in removed])
+            for path, (sha256, phash, width, height) in zip(changed, all_hashes):
+                self._insert(path, files[path], sha256, phash, width, height)
+            self.connection.execute('COMMIT')
+        return len(changed)
+
+    def exact_duplicates(self, folder=None):
+        """Groups of paths with the same content."""
+        groups = {}
+        for path, sha256 in self._rows('SELECT path, sha256 FROM images', folder):
+            groups.setdefault(sha256, []).append(path)
+        return [sorted(paths) for paths in groups.values() if len(paths) > 1]
+
+    def near_duplicate_clusters(self, max_distance=DEFAULT_MAX_DISTANCE, folder=None,
+                                max_cluster_size=DEFAULT_MAX_CLUSTER_SIZE):
+        """
+        Clusters of images whose perceptual hashes all differ by at most 'max_distance' bits (complete linkage:
+        two clusters are merged only if every image of one is close to every image of the other, so chains of
+        similar images, such as blank folios, do not merge unrelated images). The closest pairs are merged first
+        and a cluster never exceeds 'max_cluster_size' images.
+        Only the images sharing one of the 8 bands of their hash are compared, so max_distance must be below 8.
+        """
+        if max_distance >= NB_BANDS:
+            raise ValueError(f'max_distance must be lower than {NB_BANDS}')
+        rows = [(path, phash) for path, phash in self._rows('SELECT path, phash FROM images', folder)
+                if phash is not None]
+
+        bands = {}
+        for i, (_, phash) in enumerate(rows):
+            for band in range(NB_BANDS):
+                bands.setdefault((band, (phash >> (band * 8)) & 0xFF), []).append(i)
+        pairs = set()
+        for members in bands.values():
+            for position, i in enumerate(members):
+                for j in members[position + 1:]:
+                    distance = hamming_distance(rows[i][1], rows[j][1])
+                    if distance <= max_distance:
+                        pairs.add((distance, i, j))
+
+        cluster_of = list(range(len(rows)))
+        clusters = {i: [i] for i in range(len(rows))}
+        for _, i, j in sorted(pairs):
+            a, b = cluster_of[i], cluster_of[j]
+            if a == b or len(clusters[a]) + len(clusters[b]) > max_cluster_size:
+                continue
+            if all(hamming_distance(rows[k][1], rows[l][1]) <= max_distance for k in clusters[a] for l in clusters[b]):
+                for k in clusters[b]:
+                    cluster_of[k] = a
+                clusters[a].extend(clusters.pop(b))
+
+        return sorted((sorted(rows[i][0] for i in members) for members in clusters.values() if len(members) > 1),
+                      key=len, reverse=True)
+
+    def _rows(self, query, folder):
+        with self.lock:
+            rows = self.connection.execute(query).fetchall()
+        if folder is None:
+            return rows
+        prefix = os.path.join(folder, '')
+        return [row for row in rows if row[0].startswith(prefix)]
+
+    def report(self, report_path, max_distance=DEFAULT_MAX_DISTANCE, folder=None,
+               max_cluster_size=DEFAULT_MAX_CLUSTER_SIZE):
+        """Writes the exact duplicates and the near-duplicate clusters in a JSON report and returns it."""
+        exact = self.exact_duplicates(folder)
+        sizes = {path: size for path, size in self._rows('SELECT path, size FROM images', folder)}
+        report = {
+            'max_distance': max_distance,
+            'max_cluster_size': max_cluster_size,
+            'exact_duplicates': exact,
+            # Disk used by the copies, if they are not hardlinks
+            'duplicated_bytes': sum(sizes[path] for paths in exact for path in paths[1:]),
+            'near_duplicate_clusters': self.near_duplicate_clusters(max_distance, folder, max_cluster_size),
+        }
+        os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+        tmp_path = report_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, report_path)
+        return report
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def duplicates_report(folder, report_path, max_distance=DEFAULT_MAX_DISTANCE, db_path=None, workers=None,
+                      max_cluster_size=DEFAULT_MAX_CLUSTER_SIZE):
+    """
+    Updates the index of 'folder' ('<folder>/.dedup_index.sqlite' by default) and writes the duplicates report.
+    """
+    index = DedupIndex(db_path or os.path.join(folder, '.dedup_index.sqlite'))
+    try:
+        nb_read = index.scan(folder, workers=workers)
+        report = index.report(report_path, max_distance, folder, max_cluster_size)
+    finally:
+        index.close()
+    print(f"{nb_read} images indexed, {len(report['exact_duplicates'])} groups of identical images, "
+          f"{len(report['near_duplicate_clusters'])} clusters of near-duplicates")
+    return report
+
+
+if __name__ == '__main__':
+    duplicates_report(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else os.path.join('Statistics', 'duplicates.json'),
+                      int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_MAX_DISTANCE)
@@ -0,0 +1,560 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Shared download engine for the IIIF download scripts.
+Images are fetched by a pool of threads. Each IIIF server (host) has its own token bucket,
+which limits the number of requests per second, and its own semaphore, which limits the number
+of simultaneous connections. HTTP connections are kept open and reused through a requests.Session.
+Images are written to a temporary '.part' file which is renamed only when complete, so an interrupted
+run never leaves a truncated image under its final name. The state of every download can be recorded
+in a DownloadJournal (see download_journal.py), and the downloaded images in a DedupIndex (see dedup_index.py):
+a URL already downloaded, or an image whose content is already on disk, is linked instead of stored twice.
+Several libraries can therefore be fetched in parallel while each server still gets polite traffic.
+The pace of each server adapts to its answers: the rate goes up while the server answers well (up to
+MAX_RATE_FACTOR times the configured rate) and is halved on '429 Too Many Requests' or '503', whose
+'Retry-After' delay is respected. Failed requests are retried a few times with exponential backoff and jitter,
+and a server failing repeatedly is left alone for a while (circuit breaker) instead of stopping the run.
+"""
+
+import hashlib
+import os
+import random
+import tempfile
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from dedup_index import DedupIndex, link_or_copy
+from download_journal import DownloadJournal
+from image_probe import ImageSizeSniffer, probe_image_size
+
+
+# One request every 10 seconds per server, as recommended for the previous serial loop
+DEFAULT_RATE = 0.1
+DEFAULT_CONCURRENCY = 2
+DEFAULT_WORKERS = 8
+CHUNK_SIZE = 64 * 1024
+
+# Retries of a failed request, with exponential backoff (seconds) and jitter
+MAX_RETRIES = 4
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 120.0
+# Answers after which a request is sent again; 429 and 503 also slow down the server
+RETRY_STATUS = {429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 503}
+# Adaptive pacing: the rate of a server stays between rate / MIN_RATE_DIVISOR and rate * MAX_RATE_FACTOR,
+# and goes up by RATE_INCREASE of the configured rate after each successful request
+MAX_RATE_FACTOR = 4.0
+MIN_RATE_DIVISOR = 16.0
+RATE_INCREASE = 0.05
+# Circuit breaker: after CIRCUIT_FAILURES consecutive failures, no request is sent to the server
+# during CIRCUIT_COOLDOWN seconds (doubled at each new opening, up to CIRCUIT_COOLDOWN_MAX)
+CIRCUIT_FAILURES = 5
+CIRCUIT_COOLDOWN = 60.0
+CIRCUIT_COOLDOWN_MAX = 900.0
+# Errors for which the request is sent again
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: 'rate' tokens are added per second, up to 'capacity'.
+    acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            now = time.monotonic()
+            if self.rate != float('inf'):
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = float(rate)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if self.rate == float('inf'):
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a request is not sent because its server failed too many times in a row.
+    'retry_in' is the number of seconds before a request may be sent again.
+    """
+
+    def __init__(self, message, retry_in):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class HostLimiter:
+    """
+    Rate limit and maximum number of simultaneous requests for one IIIF server.
+    The rate adapts to the answers of the server (see success() and throttled()), and the server
+    is left alone for a while after too many failures in a row (circuit breaker, see failure()).
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, concurrency=DEFAULT_CONCURRENCY, adaptive=True):
+        self.base_rate = float(rate)
+        self.rate = float(rate)
+        self.adaptive = adaptive and self.base_rate != float('inf')
+        self.bucket = TokenBucket(rate)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        # No request before this time (Retry-After)
+        self.paused_until = 0.0
+        self.failures = 0
+        self.cooldown = CIRCUIT_COOLDOWN
+        self.open_until = 0.0
+        self.trial_until = 0.0
+
+    def __enter__(self):
+        self.check()
+        self.slots.acquire()
+        try:
+            wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.bucket.acquire()
+        except BaseException:
+            self.slots.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.slots.release()
+
+    def check(self):
+        """
+        Raises CircuitOpenError if the circuit is open. Once the cooldown is over, a single trial request
+        goes through (another one if it gets no answer within CIRCUIT_COOLDOWN seconds).
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.open_until:
+                raise CircuitOpenError(f'too many failures, server left alone for {self.open_until - now:.0f} s',
+                                       self.open_until - now)
+            if self.open_until:
+                if now < self.trial_until:
+                    raise CircuitOpenError('waiting for the trial request after too many failures',
+                                           self.trial_until - now)
+                self.trial_until = now + CIRCUIT_COOLDOWN
+
+    def _set_rate(self, rate):
+        rate = min(self.base_rate * MAX_RATE_FACTOR, max(self.base_rate / MIN_RATE_DIVISOR, rate))
+        if rate != self.rate:
+            self.rate = rate
+            self.bucket.set_rate(rate)
+
+    def success(self):
+        """The server answered: the circuit is closed and the rate goes up (additive increase)."""
+        with self.lock:
+            self.failures = 0
+            self.open_until = 0.0
+            self.trial_until = 0.0
+            self.cooldown = CIRCUIT_COOLDOWN
+            if self.adaptive:
+                self._set_rate(self.rate + self.base_rate * RATE_INCREASE)
+
+    def throttled(self, retry_after=None):
+        """The server asks to slow down (429, 503): the rate is halved and the Retry-After delay is respected."""
+        with self.lock:
+            if self.adaptive:
+                self._set_rate(self.rate / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def failure(self):
+        """
+        The request failed (connection error, 5xx): the circuit opens after CIRCUIT_FAILURES failures in a row,
+        or at once if the trial request after a cooldown fails.
+        """
+        with self.lock:
+            self.failures += 1
+            if self.open_until or self.failures >= CIRCUIT_FAILURES:
+                self.open_until = time.monotonic() + self.cooldown
+                self.cooldown = min(CIRCUIT_COOLDOWN_MAX, self.cooldown * 2)
+                self.trial_until = 0.0
+                self.failures = 0
+
+
+def retry_after_seconds(value):
+    """Delay of a 'Retry-After' header (a number of seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Delay before the retry number 'attempt' (from 1): exponential backoff with full jitter, at least Retry-After."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+    return max(delay, retry_after or 0.0)
+
+
+class DownloadResult:
+    """
+    What is known about one download, taken from the single streamed response.
+    'status_code' is None when no request was sent (error before the response).
+    """
+
+    def __init__(self, url, path, status_code=None, nb_bytes=0, content_type='', elapsed=0.0,
+                 checksum='', width=None, height=None, error='', attempts=0):
+        self.url = url
+        self.path = path
+        self.status_code = status_code
+        self.nb_bytes = nb_bytes
+        self.content_type = content_type
+        self.elapsed = elapsed
+        self.checksum = checksum
+        self.width = width
+        self.height = height
+        self.error = error
+        self.attempts = attempts
+
+    @property
+    def ok(self):
+        return self.status_code == 200 and not self.error
+
+    def __bool__(self):
+        return self.ok
+
+    def as_dict(self):
+        return {
+            'url': self.url,
+            'path': self.path,
+            'status_code': self.status_code,
+            'nb_bytes': self.nb_bytes,
+            'content_type': self.content_type,
+            'elapsed': self.elapsed,
+            'checksum': self.checksum,
+            'width': self.width,
+            'height': self.height,
+            'error': self.error,
+            'attempts': self.attempts,
+        }
+
+
+def pause_to_rate(request_pause):
+    """Converts the old 'request_pause' (seconds between two requests) into a rate."""
+    if not request_pause:
+        return float('inf')
+    return 1.0 / request_pause
+
+
+class DownloadEngine:
+    """
+    Downloads files concurrently with per-host rate limits.
+    'host_limits' maps a host name (e.g. 'gallica.bnf.fr') to a dict {'rate': ..., 'concurrency': ...}
+    to override the default values for this server.
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, rate=DEFAULT_RATE,
+                 concurrency=DEFAULT_CONCURRENCY, host_limits=None, timeout=60, journal=None, dedup=None,
+                 max_retries=MAX_RETRIES, adaptive=True):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.adaptive = adaptive
+        self.journal = journal
+        self.dedup = dedup
+        self.rate = rate
+        self.concurrency = concurrency
+        self.host_limits = dict(host_limits or {})
+        self.timeout = timeout
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+
+        # Pooled HTTP connections, shared by all the threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def limiter(self, url):
+        """Returns the limiter of the server hosting 'url', creating it if needed."""
+        host = urlsplit(url).netloc
+        with self.limiters_lock:
+            if host not in self.limiters:
+                limits = self.host_limits.get(host, {})
+                self.limiters[host] = HostLimiter(limits.get('rate', self.rate),
+                                                  limits.get('concurrency', self.concurrency), self.adaptive)
+            return self.limiters[host]
+
+    def set_host_limits(self, host, rate=None, concurrency=None):
+        """Changes the limits of one server. Must be called before its first request."""
+        limits = self.host_limits.setdefault(host, {})
+        if rate is not None:
+            limits['rate'] = rate
+        if concurrency is not None:
+            limits['concurrency'] = concurrency
+
+    def is_downloaded(self, url, path):
+        """True if the image does not need to be downloaded again (journal, or the disk without journal)."""
+        if self.journal is not None:
+            return self.journal.is_downloaded(url, path)
+        return os.path.exists(path)
+
+    def image_size(self, url, path):
+        """(width, height) of a downloaded image, from the journal when there is one."""
+        if self.journal is not None:
+            return self.journal.image_size(url, path)
+        return probe_image_size(path)
+
+    def _record(self, limiter, status_code, headers):
+        """Adapts the pace of the server to its answer; returns the Retry-After delay (seconds) or None."""
+        if status_code in THROTTLE_STATUS:
+            retry_after = retry_after_seconds(headers.get('Retry-After'))
+            limiter.throttled(retry_after)
+            if status_code == 503:
+                limiter.failure()
+            return retry_after
+        if status_code in RETRY_STATUS:
+            limiter.failure()
+        else:
+            limiter.success()
+        return None
+
+    def get(self, url, **kwargs):
+        """
+        GET request through the pooled session, respecting the limits of the server.
+        Connection errors and 429/5xx answers are retried with backoff; the last response is returned,
+        or the last error raised. While the server is left alone (circuit open), the request waits for the
+        end of the cooldown, which counts as an attempt; CircuitOpenError is raised after the last attempt.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        limiter = self.limiter(url)
+        for attempt in range(self.max_retries + 1):
+            try:
+                with limiter:
+                    response = self.session.get(url, **kwargs)
+            except CircuitOpenError as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(e.retry_in)
+                continue
+            except TRANSIENT_ERRORS:
+                limiter.failure()
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(backoff_delay(attempt + 1))
+                continue
+            retry_after = self._record(limiter, response.status_code, response.headers)
+            if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                return response
+            response.close()
+            time.sleep(backoff_delay(attempt + 1, retry_after))
+
+    def fetch(self, image_url, dir_path):
+        """
+        Downloads an image from an url and stores it as a file.
+        The image is streamed only once: the status code, the size, the content type, the
+        duration of the download and the dimensions of the image are all taken from this response.
+        Connection errors and 429/5xx answers are retried (at most max_retries times) with backoff;
+        while the server is left alone (circuit open), the download waits for the end of the cooldown.
+        Returns a DownloadResult, which is true if the image was retrieved successfully.
+        """
+        result = DownloadResult(image_url, dir_path)
+        # The URL was already downloaded (for another row or manifest): the image is linked, not downloaded again
+        if self.dedup is not None:
+            known_path = self.dedup.find_url(image_url)
+            if known_path is not None:
+                return self._reuse(result, known_path)
+
+        print(f'Downloading image from {image_url}')
+        if self.journal is not None:
+            self.journal.mark_in_flight(image_url, dir_path)
+
+        limiter = self.limiter(image_url)
+        start = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            result.attempts = attempt + 1
+            result.status_code, result.nb_bytes, result.error = None, 0, ''
+            retry_after = None
+            part_path = None
+            try:
+                with limiter:
+                    r = self.session.get(image_url, stream=True, timeout=self.timeout)
+                    with r:
+                        result.status_code = r.status_code
+                        result.content_type = r.headers.get('Content-Type', '')
+                        print(r.status_code)
+                        # Check if image was retrieved successfully
+                        if r.status_code != 200:
+                            print(f"Failed to download image from {image_url}. Status code: {r.status_code}")
+                        else:
+                            checksum = hashlib.sha256()
+                            sniffer = ImageSizeSniffer()
+                            # Temporary file of its own, so that two downloads to the same path never collide
+                            fd, part_path = tempfile.mkstemp(dir=os.path.dirname(dir_path) or '.',
+                                                             prefix=os.path.basename(dir_path) + '.', suffix='.part')
+                            with os.fdopen(fd, 'wb') as image_file:
+                                for chunk in r.iter_content(CHUNK_SIZE):
+                                    image_file.write(chunk)
+                                    checksum.update(chunk)
+                                    sniffer.feed(chunk)
+                                    result.nb_bytes += len(chunk)
+                            # The image gets its final name only once it is complete (mkstemp creates it as 0600)
+                            os.chmod(part_path, 0o644)
+                            os.replace(part_path, dir_path)
+                            part_path = None
+                            result.checksum = checksum.hexdigest()
+                            if sniffer.size is not None:
+                                result.width, result.height = sniffer.size
+                retry_after = self._record(limiter, r.status_code, r.headers)
+            except CircuitOpenError as e:
+                # The image is not given up: it waits for the server like after a Retry-After
+                result.error = str(e)
+                retry_after = e.retry_in
+                print(f"Image from {image_url} not downloaded yet: {str(e)}")
+            except TRANSIENT_ERRORS as e:
+                # An interrupted body also counts as a failure of the server, even after a 200
+                result.error = str(e)
+                limiter.failure()
+                print(f"Error occurred while downloading image from {image_url}. Error message: {str(e)}")
+            except Exception as e:
+                result.error = str(e)
+                print(f"Error occurred while downloading image from {image_url}. Error message: {str(e)}")
+                break
+            finally:
+                if part_path is not None and os.path.exists(part_path):
+                    os.remove(part_path)
+
+            if result or (not result.error and result.status_code not in RETRY_STATUS):
+                break
+            if attempt < self.max_retries:
+                delay = backoff_delay(attempt + 1, retry_after)
+                print(f"Retrying {image_url} in {delay:.1f} s (attempt {attempt + 2}/{self.max_retries + 1})")
+                time.sleep(delay)
+        result.elapsed = time.monotonic() - start
+
+        if self.dedup is not None and result:
+            self._deduplicate(result)
+
+        if self.journal is not None:
+            if result:
+                self.journal.mark_done(image_url, dir_path, result.nb_bytes, result.checksum,
+                                       result.width, result.height)
+            else:
+                self.journal.mark_failed(image_url, dir_path, result.error or f'HTTP {result.status_code}')
+        return result
+
+    def _reuse(self, result, known_path):
+        """Result of a URL already downloaded at 'known_path', linked at the path asked."""
+        print(f'The image from {result.url} was already downloaded as {known_path}')
+        if known_path != result.path:
+            link_or_copy(known_path, result.path)
+        known = self.dedup.image(known_path)
+        result.status_code = 200
+        result.nb_bytes = os.path.getsize(result.path)
+        result.checksum = known['sha256']
+        result.width, result.height = known['width'], known['height']
+        if self.journal is not None:
+            self.journal.mark_done(result.url, result.path, result.nb_bytes, result.checksum, result.width, result.height)
+        if known_path != result.path:
+            self.dedup.add(result.url, result.path, result.checksum)
+        return result
+
+    def _deduplicate(self, result):
+        """Indexes a downloaded image; if the same content is already on disk, the new file becomes a link to it."""
+        try:
+            existing = self.dedup.find_sha256(result.checksum, exclude=result.path)
+            if existing is not None:
+                print(f'{result.path} is identical to {existing}')
+                link_or_copy(existing, result.path)
+            self.dedup.add(result.url, result.path, result.checksum)
+        except Exception as e:
+            print(f"Error occurred while indexing {result.path}. Error message: {str(e)}")
+
+    def submit(self, image_url, dir_path):
+        """Schedules a download and returns a Future whose result is the one of fetch()."""
+        return self.executor.submit(self.fetch, image_url, dir_path)
+
+    def download_all(self, jobs):
+        """
+        Downloads a list of (image_url, dir_path) couples concurrently.
+        Returns the list of results in the same order as 'jobs'.
+        """
+        futures = [self.submit(url, path) for url, path in jobs]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.dedup is not None:
+            self.dedup.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+
+def get_engine(request_pause=None, journal_path=None, dedup_path=None):
+    """
+    Returns the engine shared by the download scripts of this repository.
+    'request_pause' (seconds between two requests to the same server) is only used
+    when the engine is created. 'journal_path' attaches a DownloadJournal stored in this file,
+    'dedup_path' a DedupIndex.
+    """
+    global _default_engine
+    with _default_engine_lock:
+        if _default_engine is None:
+            rate = DEFAULT_RATE if request_pause is None else pause_to_rate(request_pause)
+            _default_engine = DownloadEngine(rate=rate)
+        if journal_path is not None and _default_engine.journal is None:
+            _default_engine.journal = DownloadJournal(journal_path)
+        if dedup_path is not None and _default_engine.dedup is None:
+            _default_engine.dedup = DedupIndex(dedup_path)
+        return _default_engine
+
+
+def set_engine(engine):
+    """
+    Replaces the engine shared by the download scripts (for instance by an engine with other limits)
+    and returns the previous one, which is not closed.
+    """
+    global _default_engine
+    with _default_engine_lock:
+        previous, _default_engine = _default_engine, engine
+        return previous
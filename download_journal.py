@@ -0,0 +1,159 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Persistent journal of the downloads, stored in a SQLite file and keyed by image URL.
+For each image it records its state (pending, in-flight, done, failed), the number of bytes,
+the SHA-256 checksum, the number of attempts and the dimensions of the downloaded image.
+A rerun reads the journal once and skips the images marked as done, without opening
+or checking every file on disk.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from image_probe import probe_image_size
+
+
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class DownloadJournal:
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS downloads ('
+            'url TEXT PRIMARY KEY, path TEXT, state TEXT NOT NULL, nb_bytes INTEGER, '
+            'checksum TEXT, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated REAL)'
+        )
+        # Journals created before the dimensions were recorded
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(downloads)')]
+        for column in ('width', 'height'):
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE downloads ADD COLUMN {column} INTEGER')
+        # A download still in flight means that the previous run was interrupted: retry it
+        self.connection.execute('UPDATE downloads SET state = ? WHERE state = ?', (PENDING, IN_FLIGHT))
+
+        # All the rows are loaded once, so that checking a URL does not query the database
+        self.rows = {}
+        for url, path, state, nb_bytes, checksum, attempts, width, height in self.connection.execute(
+                'SELECT url, path, state, nb_bytes, checksum, attempts, width, height FROM downloads'):
+            self.rows[url] = {'path': path, 'state': state, 'nb_bytes': nb_bytes, 'checksum': checksum,
+                              'attempts': attempts, 'width': width, 'height': height}
+
+    def _write(self, url, **values):
+        row = self.rows.setdefault(url, {'path': None, 'state': PENDING, 'nb_bytes': None, 'checksum': None,
+                                         'attempts': 0, 'width': None, 'height': None})
+        error = values.pop('error', '')
+        row.update(values)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO downloads '
+            '(url, path, state, nb_bytes, checksum, attempts, width, height, error, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (url, row['path'], row['state'], row['nb_bytes'], row['checksum'], row['attempts'],
+             row['width'], row['height'], error, time.time())
+        )
+
+    def state(self, url):
+        row = self.rows.get(url)
+        return row['state'] if row else None
+
+    def get(self, url):
+        """Returns a copy of the journal entry of 'url', or None."""
+        row = self.rows.get(url)
+        return dict(row) if row else None
+
+    def is_done(self, url, path=None):
+        """True if 'url' was completely downloaded (to 'path', if given)."""
+        row = self.rows.get(url)
+        if row is None or row['state'] != DONE:
+            return False
+        return path is None or row['path'] == path
+
+    def mark_pending(self, url, path):
+        with self.lock:
+            if self.state(url) != DONE:
+                self._write(url, path=path, state=PENDING)
+
+    def mark_in_flight(self, url, path):
+        with self.lock:
+            attempts = self.rows.get(url, {}).get('attempts') or 0
+            self._write(url, path=path, state=IN_FLIGHT, attempts=attempts + 1)
+
+    def mark_done(self, url, path, nb_bytes, checksum, width=None, height=None):
+        with self.lock:
+            self._write(url, path=path, state=DONE, nb_bytes=nb_bytes, checksum=checksum,
+                        width=width, height=height)
+
+    def mark_failed(self, url, path, error=''):
+        """Records a failed download; an image already downloaded (by another job) stays done."""
+        with self.lock:
+            if self.state(url) == DONE:
+                return
+            self._write(url, path=path, state=FAILED, error=error)
+
+    def adopt(self, url, path):
+        """
+        Records as done a file downloaded before the journal existed.
+        Its size and dimensions are read from the disk; the checksum is left empty.
+        """
+        try:
+            width, height = probe_image_size(path)
+        except Exception:
+            width, height = None, None
+        with self.lock:
+            self._write(url, path=path, state=DONE, nb_bytes=os.path.getsize(path), checksum=None,
+                        width=width, height=height)
+
+    def image_size(self, url, path):
+        """
+        Returns (width, height) of a downloaded image, from the journal if known,
+        otherwise from the header of the file (and records it).
+        """
+        row = self.rows.get(url)
+        if row is not None and row.get('width') and row['path'] == path:
+            return row['width'], row['height']
+        width, height = probe_image_size(path)
+        if row is not None and row['path'] == path:
+            with self.lock:
+                self._write(url, width=width, height=height)
+        return width, height
+
+    def is_downloaded(self, url, path):
+        """
+        True if the image does not need to be downloaded again.
+        Files on disk unknown to the journal (previous runs) are adopted; the disk is only
+        checked for URLs that are not in the journal.
+        """
+        if self.is_done(url, path):
+            return True
+        if url not in self.rows and os.path.exists(path):
+            self.adopt(url, path)
+            return True
+        return False
+
+    def unfinished(self, since=None):
+        """URLs which are not done (pending, in-flight or failed), among those updated since 'since' (time.time())."""
+        with self.lock:
+            return [url for url, in self.connection.execute(
+                'SELECT url FROM downloads WHERE state != ? AND updated >= ?', (DONE, since or 0.0))]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
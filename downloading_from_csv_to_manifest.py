@@ -14,33 +14,20 @@ Translated with www.DeepL.com/Translator (free version)
 
 import os
 import pandas as pd
-import requests
-import shutil
-import time
 import json
 import cv2
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from download_engine import get_engine
+from manifest_cache import ManifestCache
 
 
 def download_image_from_url(image_url, dir_path, request_pause):
     """
     Downloads an image from an url and stores it as a file.
+    The pause between two requests to the same server is handled by the shared download engine.
     """
-
-    print(f'Downloading image from {image_url}')
-
-    r = requests.get(image_url, stream=True)
-    print(r.status_code)
-    # Check if image was retrieved successfully
-    if r.status_code == 200:
-        r.raw.decode_content = True
-
-        with open(dir_path, 'wb') as image_file:
-            shutil.copyfileobj(r.raw, image_file)
-        # recommended request_pause = 10 seconds
-        time.sleep(request_pause)
-    else:
-        print(f"Fehler {r.status_code}")
+    # recommended request_pause = 10 seconds
+    return get_engine(request_pause).fetch(image_url, dir_path)
 
 def open_json_file(json_file_name):
     """Opens a JSON file and returns it as a dictionary."""
@@ -48,25 +35,27 @@ def open_json_file(json_file_name):
     with open(json_file_name, 'r') as json_file:
         return json.load(json_file)
 
-def download_images_from_manifest(manifest_URL, folder, ms_base_name, request_pause):
+def download_images_from_manifest(manifest_URL, folder, ms_base_name, request_pause, iiif_manifest=None):
     """
     Downloads all images from a IIIF manifest. All images are named with the name of the IIIF manifest (file) and
     after an underscore, the label of the images' canvas.
+    'iiif_manifest' is the already parsed manifest; it is downloaded only if it is not given.
     """
     print(f'Downloading all images from {manifest_URL}')
-    waittime = request_pause
     
-    response = requests.get(manifest_URL)    
-    print(response.status_code)
-    if response.status_code == 200:
+    if iiif_manifest is None:
+        response = get_engine(request_pause).get(manifest_URL)
+        print(response.status_code)
+        if response.status_code != 200:
+            print(f"Failed to download manifest {manifest_URL}. Status code: {response.status_code}")
+            return
         iiif_manifest = response.json()
-    else:
-        iiif_manifest = None
     
     # Create a list to store image information
     images_data = []
+    engine = get_engine(request_pause)
 
-    # Download images
+    # Download images: every missing image is fetched once, concurrently with the others
     for i, canvas in enumerate(iiif_manifest['sequences'][0]['canvases']):
         manifestURL = iiif_manifest['@id']
         canvasId = canvas['@id']
@@ -74,36 +63,19 @@ def download_images_from_manifest(manifest_URL, folder, ms_base_name, request_pa
         imageLabel = canvas['label']
         imageWidthAsDeclared = canvas['width']
         imageHeightAsDeclared = canvas['height']
-        image_format = urlImage.split('.')[-1]
         image_id = f"{i+1}"
-        htmlCode = requests.get(urlImage)
         path_to_store_image = os.path.join(folder, ms_base_name + '_' + image_id + '.' + "jpg")
-       
-       # Check if the images are downloaded and don't downloaded again
-        if os.path.exists(path_to_store_image):
+
+        # Check in the journal if the images are downloaded and don't downloaded again: no request is sent for them
+        if engine.is_downloaded(urlImage, path_to_store_image):
             print(f"Image {path_to_store_image} already dowloaded ")
-            htmlCode = 200
-            imageFileName = os.path.join(folder, ms_base_name + '_' + image_id + '.' + "jpg")
-            with Image.open(imageFileName) as img:
-                imageWidthAsDownloaded, imageHeightAsDownloaded = img.size
-        # If they are not dowloaded download them and add the post_download data
+            download = None
         else:
-            download_image_from_url(urlImage, path_to_store_image, waittime)
-        
-            try:
-                htmlCode = requests.get(urlImage).status_code
-                imageFileName = os.path.join(folder, ms_base_name + '_' + image_id + '.' + "jpg")
-                with Image.open(imageFileName) as img:
-                    imageWidthAsDownloaded, imageHeightAsDownloaded = img.size
-
-            except:
-                htmlCode = ""
-                imageFileName = ""
-                imageWidthAsDownloaded = ""
-                imageHeightAsDownloaded = ""
+            if engine.journal is not None:
+                engine.journal.mark_pending(urlImage, path_to_store_image)
+            download = engine.submit(urlImage, path_to_store_image)
 
-        # Add image data to the list
-        image_data = {
+        images_data.append(({
             'manifestURL': manifestURL,
             'canvasId': canvasId,
             'urlImage': urlImage,
@@ -111,12 +83,48 @@ def download_images_from_manifest(manifest_URL, folder, ms_base_name, request_pa
             'imageLabel': imageLabel,
             'imageWidthAsDeclared': imageWidthAsDeclared,
             'imageHeightAsDeclared': imageHeightAsDeclared,
+        }, path_to_store_image, download))
+
+    # Add the post_download data
+    for i, (image_data, path_to_store_image, download) in enumerate(images_data):
+        if download is None:
+            htmlCode = 200
+            entry = engine.journal.get(image_data['urlImage']) if engine.journal is not None else None
+            nb_bytes = entry['nb_bytes'] if entry else os.path.getsize(path_to_store_image)
+            contentType = ''
+            elapsed = 0.0
+        else:
+            result = download.result()
+            htmlCode = result.status_code if result.status_code is not None else ""
+            nb_bytes = result.nb_bytes
+            contentType = result.content_type
+            elapsed = result.elapsed
+
+        try:
+            if download is not None and not result:
+                raise IOError(f"{image_data['urlImage']} not downloaded")
+            imageFileName = path_to_store_image
+            # The dimensions come from the streamed download or from the journal: the pixels are never decoded
+            if download is not None and result.width is not None:
+                imageWidthAsDownloaded, imageHeightAsDownloaded = result.width, result.height
+            else:
+                imageWidthAsDownloaded, imageHeightAsDownloaded = engine.image_size(image_data['urlImage'], imageFileName)
+        except:
+            imageFileName = ""
+            imageWidthAsDownloaded = ""
+            imageHeightAsDownloaded = ""
+
+        # Add image data to the list
+        image_data.update({
             'htmlCode': htmlCode,
             'imageFileName': imageFileName,
             'imageWidthAsDownloaded': imageWidthAsDownloaded,
-            'imageHeightAsDownloaded': imageHeightAsDownloaded
-        }
-        images_data.append(image_data)
+            'imageHeightAsDownloaded': imageHeightAsDownloaded,
+            'bytesDownloaded': nb_bytes,
+            'contentType': contentType,
+            'downloadTime': elapsed
+        })
+        images_data[i] = image_data
     
     # Create a DataFrame from the image data list
     df = pd.DataFrame(images_data)
@@ -128,38 +136,71 @@ def download_images_from_manifest(manifest_URL, folder, ms_base_name, request_pa
     print(f"Image data saved to {csv_filename}")
     print('Downloads complete')
 
-def download_data(csv_data, folder):
+def download_manuscript(url_manifest, ms_name, folder, manifest_cache, request_pause=5):
+    """Saves the manifest of one manuscript and then downloads all the images of this manifest."""
+    outputfolder = os.path.join(folder, ms_name)
+    
+    # Vérifier si le dossier de destination existe, sinon le créer
+    os.makedirs(outputfolder, exist_ok=True)
+    
+    # Télécharger le fichier manifest.json (une seule fois, puis revalidé auprès du serveur)
+    content = manifest_cache.content(url_manifest)
+    if content is not None:
+        # Construire le chemin complet du fichier de destination
+        chemin_destination = os.path.join(outputfolder, ms_name + '_manifest.json')
+        
+        # Enregistrer le fichier manifest.json dans le dossier de destination
+        with open(chemin_destination, 'wb') as f:
+            f.write(content)
+            
+        print(f'Le fichier manifest.json a été téléchargé et enregistré dans {outputfolder}')
+        print()
+        print(f'Téléchargement des images depuis {url_manifest}')
+
+        # Télécharger les images du manifeste, à partir du manifeste déjà analysé
+        download_images_from_manifest(url_manifest, outputfolder, ms_name, request_pause,
+                                      iiif_manifest=manifest_cache.manifest(url_manifest))
+    else:
+        print(f'Échec du téléchargement du fichier manifest.json pour {ms_name}')
+
+def download_data(csv_data, folder, parallel_manuscripts=4, request_pause=5):
+    """
+    Downloads the manuscripts of the csv file. Several manuscripts are processed at the same time,
+    so that different libraries are fetched in parallel; the download engine keeps the traffic
+    to each server polite.
+    The rows are grouped by manifest: each manuscript is processed once, however many miniatures it has.
+    A manuscript which fails is reported and the others go on; returns the names of the failed manuscripts.
+    """
     df = pd.read_csv(csv_data, sep=';')
 
-    # Parcourir chaque ligne du fichier CSV
-    for i, row in df.iterrows():
-        url_manifest = row['Manifest_URL']
-        ms_name = row['Image_basename']
+    # Le journal des téléchargements permet de reprendre un téléchargement interrompu,
+    # et l'index des images d'éviter de stocker deux fois un folio présent dans plusieurs manifestes
+    engine = get_engine(request_pause, journal_path=os.path.join(folder, 'download_journal.sqlite'),
+                        dedup_path=os.path.join(folder, '.dedup_index.sqlite'))
+    manifest_cache = ManifestCache(engine.get, os.path.join(folder, 'manifest_cache'))
+
+    # Un seul traitement par manifeste
+    manuscripts = df.dropna(subset=['Manifest_URL']).groupby('Manifest_URL', sort=False)['Image_basename'].first()
+
+    # Parcourir chaque manuscrit du fichier CSV
+    # Une erreur sur un manuscrit (manifeste invalide, serveur injoignable...) n'arrête pas les autres
+    failed = []
+    with ThreadPoolExecutor(max_workers=parallel_manuscripts) as executor:
+        futures = {executor.submit(download_manuscript, url_manifest, ms_name, folder, manifest_cache, request_pause):
+                   (url_manifest, ms_name) for url_manifest, ms_name in manuscripts.items()}
+        for future, (url_manifest, ms_name) in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(ms_name)
+                print(f"Error occurred while downloading {ms_name} ({url_manifest}). Error message: {str(e)}")
+
+    if failed:
+        print(f"{len(failed)} manuscrits non téléchargés : {', '.join(failed)}")
+    return failed
 
-        outputfolder = os.path.join(folder, ms_name)
-        
-        # Vérifier si le dossier de destination existe, sinon le créer
-        if not os.path.exists(outputfolder):
-            os.makedirs(outputfolder)
-        
-        # Télécharger le fichier manifest.json
-        response = requests.get(url_manifest)
-        if response.status_code == 200:
-            # Construire le chemin complet du fichier de destination
-            chemin_destination = os.path.join(outputfolder, ms_name + '_manifest.json')
-            
-            # Enregistrer le fichier manifest.json dans le dossier de destination
-            with open(chemin_destination, 'wb') as f:
-                f.write(response.content)
-                
-            print(f'Le fichier manifest.json a été téléchargé et enregistré dans {outputfolder}')
-            print()
-            print(f'Téléchargement des images depuis {url_manifest}')
-
-            # Télécharger les images du manifeste
-            download_images_from_manifest(url_manifest, outputfolder, ms_name, 5)
-        else:
-            print(f'Échec du téléchargement du fichier manifest.json pour {ms_name}')
 
+if __name__ == '__main__':
+    import sys
 
-download_data('filepath.cvs', 'folder')
+    download_data(sys.argv[1], sys.argv[2])
@@ -0,0 +1,145 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Helpers for the IIIF Image API (https://iiif.io/api/image/).
+An image URL has the form {service}/{region}/{size}/{rotation}/{quality}.{format}.
+Instead of downloading the images at full resolution and resizing them for the training,
+a 'size' can be asked directly to the server. The info.json of each image service, which gives the
+dimensions of the image and the sizes supported by the server, is fetched once and cached on disk.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+
+IMAGE_URL_PATTERN = re.compile(r'^(?P<service>.+)/(?P<region>[^/]+)/(?P<size>[^/]+)/(?P<rotation>[^/]+)/(?P<quality>[^/.]+)\.(?P<format>\w+)$')
+REGION_PATTERN = re.compile(r'^(\d+),(\d+),(\d+),(\d+)$')
+
+
+def parse_image_url(image_url):
+    """Splits an IIIF Image API URL into a dict (service, region, size, rotation, quality, format), or returns None."""
+    match = IMAGE_URL_PATTERN.match(image_url)
+    return match.groupdict() if match else None
+
+
+def build_image_url(service, region='full', size='full', rotation='0', quality='default', image_format='jpg'):
+    return f'{service}/{region}/{size}/{rotation}/{quality}.{image_format}'
+
+
+def api_version(info):
+    """2 or 3, from the context of the info.json."""
+    context = info.get('@context', '')
+    if isinstance(context, list):
+        context = ' '.join(context)
+    return 3 if 'image/3' in context else 2
+
+
+def compliance_level(info):
+    """Compliance level (0, 1 or 2) declared by the image service."""
+    profile = info.get('profile', '')
+    if isinstance(profile, list):
+        profile = profile[0] if profile else ''
+    match = re.search(r'level(\d)', str(profile))
+    return int(match.group(1)) if match else 1
+
+
+def best_size(info, max_width, max_height, region=None):
+    """
+    Returns the IIIF 'size' parameter for an image that fits in max_width x max_height
+    (like the '!w,h' syntax) without being enlarged.
+    'region' is the (width, height) of the requested region, the whole image if None.
+    The limits of the server (maxWidth, maxHeight, maxArea) are respected, and a level 0 server,
+    which only serves the sizes listed in its info.json, gets the smallest listed size
+    at least as large as the target.
+    """
+    full_size = 'max' if api_version(info) == 3 else 'full'
+    source_width, source_height = region if region else (info['width'], info['height'])
+
+    scale = min(max_width / source_width, max_height / source_height, 1.0)
+    if 'maxWidth' in info:
+        scale = min(scale, info['maxWidth'] / source_width)
+    if 'maxHeight' in info:
+        scale = min(scale, info['maxHeight'] / source_height)
+    if 'maxArea' in info:
+        scale = min(scale, (info['maxArea'] / (source_width * source_height)) ** 0.5)
+
+    if compliance_level(info) == 0 and region is None and info.get('sizes'):
+        sizes = sorted(info['sizes'], key=lambda s: s['width'])
+        target_width = source_width * scale
+        candidates = [s for s in sizes if s['width'] >= target_width] or sizes[-1:]
+        chosen = candidates[0]
+        if chosen['width'] >= source_width:
+            return full_size
+        return f"{chosen['width']},{chosen['height']}"
+
+    if scale >= 1.0:
+        return full_size
+    return f'{max(1, int(source_width * scale))},'
+
+
+def region_size(region):
+    """(width, height) of an 'x,y,w,h' region, or None for 'full' and the other syntaxes."""
+    match = REGION_PATTERN.match(region)
+    if match:
+        return int(match.group(3)), int(match.group(4))
+    return None
+
+
+class InfoCache:
+    """
+    info.json of the image services, fetched once per service and stored in 'cache_folder'
+    so that the next runs do not fetch them again.
+    'get' is a function which sends a GET request (e.g. DownloadEngine.get).
+    """
+
+    def __init__(self, get, cache_folder):
+        self.get = get
+        self.cache_folder = cache_folder
+        os.makedirs(cache_folder, exist_ok=True)
+        self.infos = {}
+        self.lock = threading.Lock()
+
+    def _cache_path(self, service):
+        return os.path.join(self.cache_folder, hashlib.sha1(service.encode('utf-8')).hexdigest() + '.json')
+
+    def info(self, service):
+        with self.lock:
+            if service in self.infos:
+                return self.infos[service]
+
+        cache_path = self._cache_path(service)
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+        else:
+            response = self.get(service + '/info.json')
+            response.raise_for_status()
+            info = response.json()
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(info, f)
+            os.replace(tmp_path, cache_path)
+
+        with self.lock:
+            self.infos[service] = info
+        return info
+
+    def sized_url(self, image_url, max_width, max_height):
+        """
+        Rewrites an IIIF image URL so that the server sends an image fitting in max_width x max_height.
+        Returns (url, info) where info is the info.json of the service (None if the URL is not an IIIF URL).
+        """
+        parts = parse_image_url(image_url)
+        if parts is None:
+            return image_url, None
+        info = self.info(parts['service'])
+        size = best_size(info, max_width, max_height, region_size(parts['region']))
+        return build_image_url(parts['service'], parts['region'], size, parts['rotation'],
+                               parts['quality'], parts['format']), info
@@ -0,0 +1,115 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Reads the dimensions (width, height) of JPEG, PNG and GIF images from their headers only,
+without decoding the pixels. The dimensions can be read from a file, or from the bytes of a
+download as they are written (ImageSizeSniffer).
+"""
+
+from PIL import Image
+
+
+# Maximum number of bytes read to find the dimensions (large EXIF/ICC segments can precede them in a JPEG)
+MAX_HEADER_SIZE = 1024 * 1024
+
+# JPEG "Start Of Frame" markers, which contain the dimensions of the image
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg_size(data):
+    i = 2
+    while True:
+        # Skip the fill bytes before the marker
+        while i < len(data) and data[i] == 0xFF:
+            i += 1
+        if i >= len(data):
+            return None
+        marker = data[i]
+        i += 1
+        # Markers without length
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ValueError('no frame header before the image data')
+        if i + 2 > len(data):
+            return None
+        segment_length = int.from_bytes(data[i:i + 2], 'big')
+        if marker in JPEG_SOF_MARKERS:
+            if i + 7 > len(data):
+                return None
+            height = int.from_bytes(data[i + 3:i + 5], 'big')
+            width = int.from_bytes(data[i + 5:i + 7], 'big')
+            return width, height
+        i += segment_length
+
+
+def parse_image_size(data):
+    """
+    Returns (width, height) from the first bytes of an image, or None if more bytes are needed.
+    Raises ValueError if the format is not recognized.
+    """
+    if data[:2] == b'\xff\xd8':
+        return _jpeg_size(data)
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(data) < 24:
+            return None
+        return int.from_bytes(data[16:20], 'big'), int.from_bytes(data[20:24], 'big')
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        if len(data) < 10:
+            return None
+        return int.from_bytes(data[6:8], 'little'), int.from_bytes(data[8:10], 'little')
+    if len(data) < 8:
+        return None
+    raise ValueError('unknown image format')
+
+
+def probe_image_size(path):
+    """
+    Returns (width, height) of an image file by reading only its header.
+    Falls back on PIL for the formats which are not parsed here.
+    """
+    data = b''
+    with open(path, 'rb') as f:
+        while len(data) < MAX_HEADER_SIZE:
+            chunk = f.read(max(4096, len(data)))
+            data += chunk
+            try:
+                size = parse_image_size(data)
+            except ValueError:
+                break
+            if size is not None:
+                return size
+            if not chunk:
+                break
+    with Image.open(path) as img:
+        return img.size
+
+
+class ImageSizeSniffer:
+    """
+    Finds the dimensions of an image in the chunks of a download, as they are received.
+    'size' is None until the header has been received (or if the format is not recognized).
+    """
+
+    def __init__(self):
+        self.data = b''
+        self.size = None
+        self.done = False
+
+    def feed(self, chunk):
+        if self.done:
+            return
+        self.data += chunk
+        try:
+            self.size = parse_image_size(self.data)
+        except ValueError:
+            self.size = None
+            self.done = True
+        if self.size is not None or len(self.data) >= MAX_HEADER_SIZE:
+            self.done = True
+        if self.done:
+            self.data = b''
@@ -0,0 +1,237 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Compact store for the YOLO label files (.txt) of a dataset.
+All the boxes of the folder are packed into one NumPy array (class, x, y, w, h, confidence), the confidence
+being NaN for the annotations, and an index gives for each label file the position of its boxes in the array:
+the boxes of the i-th file are boxes[offsets[i]:offsets[i + 1]].
+The arrays are saved as .npy files and opened with memory mapping, so statistics and evaluation read
+one file instead of opening thousands of small .txt files.
+The number of lines and the encoding of each file are kept in the index, for the statistics of the dataset.
+The store is rebuilt incrementally: only the label files whose modification time or size changed are read again.
+It is kept in a hidden folder of the label folder ('.labels.store'), shared by the split, the statistics,
+the box analytics and the evaluation.
+
+    store = build_label_store('labels/train')
+    for name, boxes in store.items():
+        ...
+"""
+
+import codecs
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+STORE_VERSION = 2
+STORE_NAME = '.labels.store'
+# class, x, y, w, h, confidence
+NB_COLUMNS = 6
+
+
+def decode_annotation(rawdata):
+    """
+    Decodes the content of an annotation file: returns the text and the encoding recognized
+    ('utf-8', 'iso-8859-1', or None if the encoding is not recognized).
+    """
+    # 'utf-8-sig' also removes the byte order mark written by some Windows editors
+    try:
+        return codecs.decode(rawdata, 'utf-8-sig'), 'utf-8'
+    except UnicodeDecodeError:
+        try:
+            return codecs.decode(rawdata, 'iso-8859-1'), 'iso-8859-1'
+        except UnicodeDecodeError:
+            return rawdata.decode('utf-8', errors='replace'), None
+
+
+def parse_label_file(path):
+    """
+    Reads a YOLO label file and returns (boxes, number of lines, encoding): boxes is a float32 array (N, 6),
+    the confidence being NaN if absent. Commas are treated as separators and lines which are not boxes are ignored.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    text, encoding = decode_annotation(raw)
+    lines = text.splitlines()
+
+    rows = []
+    for line in lines:
+        values = line.replace(',', ' ').split()
+        if len(values) not in (5, 6):
+            continue
+        try:
+            row = [float(value) for value in values]
+        except ValueError:
+            continue
+        if len(row) == 5:
+            row.append(np.nan)
+        rows.append(row)
+    if not rows:
+        return np.zeros((0, NB_COLUMNS), dtype=np.float32), len(lines), encoding
+    return np.asarray(rows, dtype=np.float32), len(lines), encoding
+
+
+def read_label_file(path):
+    """Reads a YOLO label file and returns its boxes as a float32 array (N, 6) (see parse_label_file)."""
+    return parse_label_file(path)[0]
+
+
+def scan_label_files(label_dir):
+    """Returns {name: (path, mtime_ns, size)} for the .txt files of label_dir, with a single os.scandir."""
+    files = {}
+    with os.scandir(label_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt') and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (entry.path, stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def _load_array(store_dir, name):
+    path = os.path.join(store_dir, name + '.npy')
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # An empty array cannot be memory-mapped
+        return np.load(path)
+
+
+class LabelStore:
+    """Label store opened from 'store_dir' (arrays memory-mapped in read-only mode)."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.json'), 'r', encoding='utf-8') as f:
+            self.index = json.load(f)
+        self.names = self.index['names']
+        # Number of lines and encoding of each label file
+        self.lines = self.index['lines']
+        self.encodings = self.index['encodings']
+        self.boxes = _load_array(store_dir, 'boxes')
+        self.offsets = _load_array(store_dir, 'offsets')
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        # A build interrupted between the arrays and the index leaves an inconsistent store
+        if (len(self.offsets) != len(self.names) + 1 or int(self.offsets[-1]) != len(self.boxes)
+                or self.index.get('nb_boxes') != len(self.boxes)):
+            raise ValueError(f'inconsistent label store {store_dir}')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def boxes_of(self, name):
+        """Boxes (N, 6) of one label file."""
+        i = self.positions[name]
+        return self.boxes[self.offsets[i]:self.offsets[i + 1]]
+
+    def items(self):
+        for i, name in enumerate(self.names):
+            yield name, self.boxes[self.offsets[i]:self.offsets[i + 1]]
+
+    def counts(self):
+        """Number of boxes of each label file, in the order of 'names'."""
+        return np.diff(self.offsets)
+
+    def image_index(self):
+        """For each box, the position of its label file in 'names'."""
+        return np.repeat(np.arange(len(self.names)), self.counts())
+
+
+def _save_array(store_dir, name, array):
+    tmp_path = os.path.join(store_dir, name + '.tmp.npy')
+    np.save(tmp_path, array)
+    os.replace(tmp_path, os.path.join(store_dir, name + '.npy'))
+
+
+def build_label_store(label_dir, store_dir=None, workers=None, parallel_above=2000):
+    """
+    Creates or updates the store of label_dir ('<label_dir>/.labels.store' by default) and returns it opened.
+    Only the label files added or modified since the last build are read; when there are more than
+    'parallel_above' of them (first build), they are read by a pool of 'workers' processes.
+    """
+    if store_dir is None:
+        store_dir = os.path.join(label_dir, STORE_NAME)
+    os.makedirs(store_dir, exist_ok=True)
+
+    files = scan_label_files(label_dir)
+
+    previous = None
+    if os.path.exists(os.path.join(store_dir, 'index.json')):
+        try:
+            previous = LabelStore(store_dir)
+            if previous.index.get('version') != STORE_VERSION:
+                previous = None
+        except (OSError, ValueError, KeyError):
+            previous = None
+
+    names = sorted(files)
+    if previous is not None and previous.names == names:
+        old_stats = previous.index['stats']
+        if all(tuple(old_stats[name]) == files[name][1:] for name in names):
+            # Nothing changed since the last build
+            return previous
+
+    parsed = {}
+    to_read = []
+    for name in names:
+        path, mtime_ns, size = files[name]
+        if previous is not None and name in previous and tuple(previous.index['stats'][name]) == (mtime_ns, size):
+            parsed[name] = (np.asarray(previous.boxes_of(name)), previous.lines[name], previous.encodings[name])
+        else:
+            to_read.append(name)
+    paths = [files[name][0] for name in to_read]
+    if len(paths) > parallel_above and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed.update(zip(to_read, executor.map(parse_label_file, paths, chunksize=256)))
+    else:
+        parsed.update((name, parse_label_file(path)) for name, path in zip(to_read, paths))
+    nb_read = len(to_read)
+
+    arrays = [parsed[name][0] for name in names]
+
+    counts = np.array([len(array) for array in arrays], dtype=np.int64)
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    boxes = np.concatenate(arrays) if arrays else np.zeros((0, NB_COLUMNS), dtype=np.float32)
+    # The previous arrays are memory-mapped: release them before replacing the files
+    lines = {name: parsed[name][1] for name in names}
+    encodings = {name: parsed[name][2] for name in names}
+    arrays = None
+    parsed = None
+    previous = None
+
+    _save_array(store_dir, 'boxes', boxes.astype(np.float32, copy=False))
+    _save_array(store_dir, 'offsets', offsets)
+    # The index is written last: it is only replaced once the arrays are complete
+    index = {
+        'version': STORE_VERSION,
+        'label_dir': os.path.abspath(label_dir),
+        'names': names,
+        'nb_boxes': len(boxes),
+        'stats': {name: [files[name][1], files[name][2]] for name in names},
+        'lines': lines,
+        'encodings': encodings,
+    }
+    tmp_path = os.path.join(store_dir, 'index.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(store_dir, 'index.json'))
+
+    print(f'{nb_read} label files read, {len(names) - nb_read} reused from {store_dir}')
+    return LabelStore(store_dir)
+
+
+if __name__ == '__main__':
+    import sys
+
+    for folder in sys.argv[1:]:
+        store = build_label_store(folder)
+        print(f'{folder}: {len(store)} label files, {len(store.boxes)} boxes')
@@ -0,0 +1,105 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Cache of the IIIF manifests.
+Each manifest is stored on disk with its ETag and Last-Modified headers. On the next runs the server
+is only asked whether the manifest changed (conditional request, answered by '304 Not Modified'),
+and within a run each manifest is downloaded and parsed only once.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+
+class ManifestCache:
+    """
+    'get' is a function which sends a GET request (e.g. DownloadEngine.get),
+    'cache_folder' the folder where the manifests are stored.
+    """
+
+    def __init__(self, get, cache_folder):
+        self.get = get
+        self.cache_folder = cache_folder
+        os.makedirs(cache_folder, exist_ok=True)
+        self.contents = {}
+        self.parsed = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def _paths(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_folder, name + '.json'), os.path.join(self.cache_folder, name + '.meta.json')
+
+    def _url_lock(self, url):
+        with self.lock:
+            return self.locks.setdefault(url, threading.Lock())
+
+    def _write(self, path, content):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def content(self, url):
+        """
+        Returns the raw content (bytes) of the manifest, revalidated with the server once per run.
+        Returns None if the manifest cannot be downloaded and is not in the cache.
+        """
+        # Two threads asking for the same manifest wait for a single request
+        with self._url_lock(url):
+            if url in self.contents:
+                return self.contents[url]
+
+            body_path, meta_path = self._paths(url)
+            headers = {}
+            meta = {}
+            if os.path.exists(body_path) and os.path.exists(meta_path):
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+            content = None
+            try:
+                response = self.get(url, headers=headers)
+                if response.status_code == 304:
+                    with open(body_path, 'rb') as f:
+                        content = f.read()
+                elif response.status_code == 200:
+                    content = response.content
+                    self._write(body_path, content)
+                    self._write(meta_path, json.dumps({
+                        'url': url,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                    }).encode('utf-8'))
+                else:
+                    print(f"Failed to download manifest {url}. Status code: {response.status_code}")
+            except Exception as e:
+                print(f"Error occurred while downloading manifest {url}. Error message: {str(e)}")
+
+            # The server cannot be reached: use the stored copy if there is one
+            if content is None and os.path.exists(body_path):
+                with open(body_path, 'rb') as f:
+                    content = f.read()
+
+            self.contents[url] = content
+            return content
+
+    def manifest(self, url):
+        """Returns the manifest parsed as a dictionary (parsed once per run), or None."""
+        content = self.content(url)
+        if content is None:
+            return None
+        with self._url_lock(url):
+            if url not in self.parsed:
+                self.parsed[url] = json.loads(content)
+            return self.parsed[url]
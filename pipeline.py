@@ -0,0 +1,435 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+End-to-end pipeline: CSV enrichment -> downloads (Books in Books and IIIF manifests) -> label normalization
+-> image preprocessing (letterbox, tiling) -> duplicates report -> train/val/test split -> statistics -> evaluation, and IIIF annotation lists of the predictions on the manuscripts.
+Each stage declares its inputs and outputs. The inputs are fingerprinted with the SHA-256 of their content
+(a folder by the hashes of all its files); a stage is skipped when its fingerprint and its parameters are
+the same as at its last successful run and its outputs exist. The stages read the outputs of the previous
+ones, so a change only re-runs the stages which depend on it.
+The hashes are cached by modification time and size (as in statistics_cache.py), so unchanged files are not read again.
+
+    python pipeline.py pipeline.json [stage ...] [--force stage ...] [--dry-run]
+
+The configuration is a JSON file overriding DEFAULT_CONFIG. A stage whose inputs are not configured
+is left out of the pipeline.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+DEFAULT_CONFIG = {
+    # Folder of the pipeline state and of the intermediate files
+    'work_folder': 'pipeline',
+    # Books in Books: csv files, folder of the images and requested size of the images
+    'books_csv': None,
+    'horae_csv': 'Export_horae_t98.csv',
+    'data_folder': 'data',
+    'output_folder': 'training_1',
+    'target_size': None,
+    # Manuscripts downloaded from their IIIF manifest
+    'manuscripts_csv': None,
+    'manuscripts_folder': os.path.join('data', 'Manuscripts'),
+    'request_pause': 5,
+    # Predictions of the model on the images of the manuscripts, published as IIIF annotation lists
+    'manuscripts_predictions': None,
+    'annotation_lists_folder': 'annotation_lists',
+    'annotation_lists_base_url': '',
+    # Annotated dataset (images and YOLO label files) and YOLO dataset built from it
+    'dataset_folder': None,
+    # Training size of the images (letterbox) and size of the tiles of the large folios (None: no preprocessing, no tiling)
+    'image_size': None,
+    'tile_size': None,
+    'tile_overlap': 0.2,
+    'preprocessed_folder': 'preprocessed',
+    # Report of the near-duplicate images, kept in the same set by the split (None: no deduplication)
+    'duplicates_report': os.path.join('Statistics', 'duplicates.json'),
+    'dedup_max_distance': 6,
+    'dedup_max_cluster_size': 16,
+    'split_ratios': [0.8, 0.1, 0.1],
+    'split_seed': 0,
+    'yolo_folder': 'yolo_dataset',
+    'link_mode': 'hardlink',
+    'statistics_report': os.path.join('Statistics', 'statistics.json'),
+    # Evaluation of the predictions of the model
+    'annotations_folder': None,
+    'predictions_folder': None,
+    'results_folder': 'results',
+    # .csv, or .parquet if pyarrow or fastparquet is installed
+    'results_file': 'results_for_graphics.csv',
+    'iou_threshold': 0.5,
+}
+
+# Files written or updated by the stages themselves, which are not part of the content of a folder
+IGNORED_SUFFIXES = ('.part', '.tmp', '.sqlite', '.sqlite-wal', '.sqlite-shm', '.checkpoint.jsonl')
+
+
+class HashCache:
+    """SHA-256 of the files, stored with their modification time and size so that only modified files are read."""
+
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, sha256 TEXT)')
+        self.connection.commit()
+
+    def file_hash(self, path, stat=None):
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        row = self.connection.execute('SELECT mtime_ns, size, sha256 FROM hashes WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_mtime_ns, stat.st_size):
+            return row[2]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        self.connection.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                                (path, stat.st_mtime_ns, stat.st_size, digest))
+        return digest
+
+    def folder_hash(self, folder):
+        """Hash of the relative paths and of the content of all the files of the folder (hidden files excluded)."""
+        from prepared_data_for_yolo import SET_FILES
+
+        files = []
+        for root, dirs, names in os.walk(folder):
+            dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+            for name in names:
+                if name.startswith('.') or name in SET_FILES or name.endswith(IGNORED_SUFFIXES):
+                    continue
+                path = os.path.join(root, name)
+                files.append((os.path.relpath(path, folder), path))
+        sha256 = hashlib.sha256()
+        for relative_path, path in sorted(files):
+            sha256.update(f'{relative_path}\0{self.file_hash(path)}\n'.encode('utf-8'))
+        return sha256.hexdigest()
+
+    def path_hash(self, path):
+        if os.path.isdir(path):
+            return self.folder_hash(path)
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        return None
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class Stage:
+    """
+    A stage of the pipeline: 'run' is called with no argument, 'inputs' and 'outputs' are paths (files or folders),
+    'params' the parameters which change the result of the stage.
+    """
+
+    def __init__(self, name, run, inputs, outputs, params=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+
+    def depends_on(self, other):
+        """True if one of the inputs of the stage is an output of 'other' (or inside one of its output folders)."""
+        for input_path in self.inputs:
+            input_path = os.path.abspath(input_path)
+            for output_path in other.outputs:
+                output_path = os.path.abspath(output_path)
+                if input_path == output_path or input_path.startswith(output_path + os.sep):
+                    return True
+        return False
+
+
+def with_own_engine(run):
+    """
+    Runs a download stage with a download engine of its own: the shared engine of download_engine is
+    created by the first caller of get_engine(), so the pace, the journal and the deduplication index of
+    one stage would otherwise be those of the previous one. The engine is closed at the end of the stage.
+    The stage fails (and is therefore run again next time) if 'run' returns failed items, or if images
+    requested during the stage are left pending or failed in the download journal.
+    """
+    def stage():
+        from download_engine import set_engine
+
+        previous = set_engine(None)
+        start = time.time()
+        unfinished = []
+        try:
+            failed = run()
+        finally:
+            engine = set_engine(previous)
+            if engine is not None:
+                if engine.journal is not None:
+                    unfinished = engine.journal.unfinished(since=start)
+                engine.close()
+        if failed:
+            raise RuntimeError(f"Not downloaded: {', '.join(map(str, failed))}")
+        if unfinished:
+            raise RuntimeError(f'{len(unfinished)} images not downloaded (see the download journal), '
+                               f'first: {unfinished[0]}')
+    return stage
+
+
+def _books_stages(config, work):
+    from Download_script_for_books_in_miniature import download_books, enrich_books_file
+
+    books_name = os.path.splitext(os.path.basename(config['books_csv']))[0]
+    enriched_csv = os.path.join(work, books_name + '.enriched.csv')
+    downloaded_csv = os.path.join(work, books_name + '.downloaded.csv')
+    miniatures = os.path.join(config['data_folder'], 'Miniatures', config['output_folder'])
+    folios = os.path.join(config['data_folder'], 'Folios', config['output_folder'])
+    return [
+        Stage('enrich', lambda: enrich_books_file(config['books_csv'], config['horae_csv'], enriched_csv),
+              inputs=[config['books_csv'], config['horae_csv']], outputs=[enriched_csv]),
+        Stage('download_books',
+              with_own_engine(lambda: download_books(enriched_csv, config['data_folder'], config['output_folder'],
+                                                     target_size=config['target_size'], output_path=downloaded_csv)),
+              inputs=[enriched_csv], outputs=[downloaded_csv, miniatures, folios],
+              params={'target_size': config['target_size']}),
+    ]
+
+
+def _manuscripts_stages(config, work):
+    from downloading_from_csv_to_manifest import download_data
+
+    stages = [
+        Stage('download_manuscripts',
+              with_own_engine(lambda: download_data(config['manuscripts_csv'], config['manuscripts_folder'],
+                                                    request_pause=config['request_pause'])),
+              inputs=[config['manuscripts_csv']], outputs=[config['manuscripts_folder']]),
+    ]
+    if config['manuscripts_predictions']:
+        from annotation_lists import annotation_lists
+
+        stages.append(Stage('annotation_lists',
+                            lambda: annotation_lists(config['manuscripts_folder'], config['manuscripts_predictions'],
+                                                     config['annotation_lists_folder'],
+                                                     config['annotation_lists_base_url']),
+                            inputs=[config['manuscripts_folder'], config['manuscripts_predictions']],
+                            outputs=[config['annotation_lists_folder']],
+                            params={'base_url': config['annotation_lists_base_url']}))
+    return stages
+
+
+def _dataset_stages(config, work):
+    from prepared_data_for_yolo import clean_comma, create_grouped_txt_train_val_test, materialize_dataset
+    from Statistics_scipts_for_annotated_data import statistics_report
+
+    dataset = config['dataset_folder']
+    yolo = config['yolo_folder']
+    # The split is done on the preprocessed images if there are any
+    training = config['preprocessed_folder'] if config['image_size'] else dataset
+
+    report = config['duplicates_report']
+
+    def split():
+        clusters = None
+        if report:
+            with open(report, 'r', encoding='utf-8') as f:
+                clusters = json.load(f)['near_duplicate_clusters']
+        create_grouped_txt_train_val_test(training, tuple(config['split_ratios']), config['split_seed'], clusters)
+        materialize_dataset(training, yolo, mode=config['link_mode'])
+
+    stages = [
+        # The label files are normalized in place: the stage is recorded with the normalized content
+        Stage('normalize_labels', lambda: clean_comma(dataset), inputs=[dataset], outputs=[dataset]),
+    ]
+    if config['image_size']:
+        from preprocess_images import preprocess_folder
+
+        stages.append(Stage('preprocess',
+                            lambda: preprocess_folder(dataset, training, config['image_size'], config['tile_size'],
+                                                      config['tile_overlap']),
+                            inputs=[dataset], outputs=[training],
+                            params={'size': config['image_size'], 'tile_size': config['tile_size'],
+                                    'overlap': config['tile_overlap']}))
+    if report:
+        from dedup_index import duplicates_report
+
+        stages.append(Stage('dedup', lambda: duplicates_report(training, report, config['dedup_max_distance'],
+                                                               max_cluster_size=config['dedup_max_cluster_size']),
+                            inputs=[training], outputs=[report],
+                            params={'max_distance': config['dedup_max_distance'],
+                                    'max_cluster_size': config['dedup_max_cluster_size']}))
+    return stages + [
+        Stage('split', split, inputs=[training] + ([report] if report else []), outputs=[yolo],
+              params={'ratios': config['split_ratios'], 'seed': config['split_seed'], 'mode': config['link_mode']}),
+        Stage('statistics', lambda: statistics_report(dataset, config['statistics_report']),
+              inputs=[dataset], outputs=[config['statistics_report']]),
+    ]
+
+
+def _evaluation_stages(config, work):
+    from coco_metrics import evaluate_with_results
+    from Results_from_YOLOv7 import parquet_engine, save_results
+
+    # Checked before the evaluation rather than when the results are written, at the very end
+    if config['results_file'].endswith('.parquet') and parquet_engine() is None:
+        raise ValueError(f"results_file {config['results_file']}: writing Parquet needs pyarrow or fastparquet")
+
+    annotations = config['annotations_folder'] or os.path.join(config['yolo_folder'], 'labels', 'test')
+    predictions = config['predictions_folder']
+    results = config['results_folder']
+    metrics_file = os.path.join(results, 'metrics.json')
+    curves_file = os.path.join(results, 'precision_recall_curves.csv')
+    results_file = os.path.join(results, config['results_file'])
+
+    def run():
+        os.makedirs(results, exist_ok=True)
+        # The metrics and the table of the TP/FP/FN come from the same reading and matching of the boxes
+        metrics, curves, table = evaluate_with_results(annotations, predictions, threshold=config['iou_threshold'])
+        with open(metrics_file, 'w') as f:
+            json.dump(metrics, f, indent=2)
+        curves.to_csv(curves_file, index=False)
+        save_results(table, results_file)
+        print(f"mAP@.5 : {metrics['mAP@.5']}")
+
+    return [
+        Stage('evaluate', run, inputs=[annotations, predictions], outputs=[metrics_file, curves_file, results_file],
+              params={'iou_threshold': config['iou_threshold']}),
+    ]
+
+
+def build_stages(config):
+    """Stages of the pipeline for 'config', in an order where every stage comes after the stages it depends on."""
+    work = config['work_folder']
+    stages = []
+    if config['books_csv']:
+        stages += _books_stages(config, work)
+    if config['manuscripts_csv']:
+        stages += _manuscripts_stages(config, work)
+    if config['dataset_folder']:
+        stages += _dataset_stages(config, work)
+    if config['predictions_folder']:
+        stages += _evaluation_stages(config, work)
+    return stages
+
+
+def upstream(stages, names):
+    """The stages named in 'names' and all the stages they depend on, in the order of 'stages'."""
+    selected = set(names)
+    for stage in reversed(stages):
+        if stage.name in selected:
+            selected.update(other.name for other in stages if other is not stage and stage.depends_on(other))
+    return [stage for stage in stages if stage.name in selected]
+
+
+class Pipeline:
+
+    def __init__(self, stages, work_folder):
+        self.stages = stages
+        os.makedirs(work_folder, exist_ok=True)
+        self.state_path = os.path.join(work_folder, 'state.json')
+        self.hashes = HashCache(os.path.join(work_folder, 'hashes.sqlite'))
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def fingerprint(self, stage):
+        """Fingerprint of the parameters and of the content of the inputs of the stage."""
+        inputs = {path: self.hashes.path_hash(path) for path in stage.inputs}
+        self.hashes.commit()
+        key = json.dumps({'params': stage.params, 'inputs': inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def is_up_to_date(self, stage):
+        return (stage.name in self.state and self.state[stage.name]['fingerprint'] == self.fingerprint(stage)
+                and all(os.path.exists(path) for path in stage.outputs))
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def run(self, targets=None, force=(), dry_run=False):
+        """
+        Runs the stages which are out of date, or only 'targets' and the stages they depend on.
+        The stages in 'force' are run in any case, and every stage depending on a stage which ran is checked again.
+        Returns the names of the stages which ran (or would run, with dry_run).
+        """
+        stages = upstream(self.stages, targets) if targets else self.stages
+        ran = []
+        for stage in stages:
+            # With dry_run, the stages which would run have not changed their outputs yet:
+            # a stage depending on one of them would run too
+            stale = dry_run and any(other.name in ran for other in stages
+                                    if other is not stage and stage.depends_on(other))
+            missing = [path for path in stage.inputs if not os.path.exists(path)]
+            if missing and not stale:
+                raise FileNotFoundError(f"Stage {stage.name}: missing inputs {', '.join(missing)}")
+            if stage.name not in force and not stale and self.is_up_to_date(stage):
+                print(f'[{stage.name}] up to date')
+                continue
+            if dry_run:
+                print(f'[{stage.name}] would run')
+                ran.append(stage.name)
+                continue
+
+            print(f'[{stage.name}] running')
+            start = time.time()
+            stage.run()
+            # The fingerprint is taken after the run, so stages which update their inputs in place are not run again
+            self.state[stage.name] = {'fingerprint': self.fingerprint(stage), 'finished': time.time(),
+                                      'duration': time.time() - start}
+            self._save_state()
+            ran.append(stage.name)
+        return ran
+
+    def close(self):
+        self.hashes.close()
+
+
+def load_config(path):
+    config = dict(DEFAULT_CONFIG)
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the stages of the pipeline which are out of date.')
+    parser.add_argument('config', nargs='?', help='JSON configuration file')
+    parser.add_argument('stages', nargs='*', help='stages to run (with the stages they depend on); all by default')
+    parser.add_argument('--force', nargs='+', default=[], help='stages to run even if they are up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only print the stages which would run')
+    parser.add_argument('--list', action='store_true', help='print the stages and their dependencies')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    stages = build_stages(config)
+    names = [stage.name for stage in stages]
+    for name in args.stages + args.force:
+        if name not in names:
+            parser.error(f"unknown stage '{name}' (stages: {', '.join(names)})")
+
+    if args.list:
+        for stage in stages:
+            dependencies = [other.name for other in stages if other is not stage and stage.depends_on(other)]
+            print(f"{stage.name}: {', '.join(dependencies) or '-'}")
+        return
+
+    pipeline = Pipeline(stages, config['work_folder'])
+    try:
+        pipeline.run(args.stages or None, force=set(args.force), dry_run=args.dry_run)
+    finally:
+        pipeline.close()
+
+
+if __name__ == '__main__':
+    main()
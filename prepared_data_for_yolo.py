@@ -6,27 +6,118 @@ under the joint supervision of the University of Humboldt (Berlin) and the IRHT-
 ---
 """
 
+import math
 import os
+import re
 import shutil
 import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from label_store import build_label_store, decode_annotation
+
+# Files written in the dataset folder which are not label files
+SET_FILES = {"traindata.txt", "valdata.txt", "testdata.txt", "train_dataset.txt"}
+
+# Boxes smaller than this (relative width or height) are dropped
+MIN_BOX_SIZE = 1e-6
+
+
+# This function tells if a line is made of numbers only, as the lines of a YOLO label file
+def is_numeric_line(line):
+    try:
+        return [float(value) for value in line.replace(',', ' ').split()] != []
+    except ValueError:
+        return False
+
+
+# This function normalizes the lines of a YOLO label file: commas are removed, the boxes are clamped to the image ([0, 1])
+# and the degenerate boxes (no width or no height after clamping) are dropped.
+# Returns the new lines and the number of lines clamped and dropped.
+def normalize_label_lines(lines):
+    new_lines = []
+    clamped = 0
+    dropped = 0
+    for line in lines:
+        values = line.replace(',', ' ').split()
+        if not values:
+            continue
+        try:
+            # Raises ValueError if a value is not a number or if there are less than 5 values
+            # (OverflowError for an infinite class)
+            class_code = int(float(values[0]))
+            x, y, w, h = (float(value) for value in values[1:5])
+        except (ValueError, OverflowError):
+            dropped += 1
+            continue
+        # 'nan' and 'inf' are parsed by float() and NaN passes every comparison below
+        if not all(math.isfinite(value) for value in (x, y, w, h)):
+            dropped += 1
+            continue
+
+        x_min, y_min = max(0.0, x - w / 2), max(0.0, y - h / 2)
+        x_max, y_max = min(1.0, x + w / 2), min(1.0, y + h / 2)
+        if x_max - x_min <= MIN_BOX_SIZE or y_max - y_min <= MIN_BOX_SIZE:
+            dropped += 1
+            continue
+
+        if (x_min, y_min, x_max, y_max) == (x - w / 2, y - h / 2, x + w / 2, y + h / 2):
+            # Valid box: the values are kept as they were written
+            new_lines.append(' '.join(values))
+        else:
+            clamped += 1
+            x, y = (x_min + x_max) / 2, (y_min + y_max) / 2
+            w, h = x_max - x_min, y_max - y_min
+            new_lines.append(' '.join([str(class_code)] + [f'{value:.6f}' for value in (x, y, w, h)] + values[5:]))
+    return new_lines, clamped, dropped
+
+
+# This function normalizes one label file. The file is only written if its content changes,
+# through a temporary file renamed over the original one, so an interruption never leaves a half written file.
+def normalize_label_file(file_path):
+    with open(file_path, 'rb') as file:
+        rawdata = file.read()
+    content, file_encoding = decode_annotation(rawdata)
+    lines = content.splitlines()
+    new_lines, clamped, dropped = normalize_label_lines(lines)
+
+    result = {'file': file_path, 'encoding': file_encoding, 'clamped': clamped, 'dropped': dropped, 'rewritten': False}
+    # A non empty file without any line of numbers (e.g. classes.txt) is not a label file: it is left untouched.
+    # A label file whose boxes are all dropped is emptied.
+    if not any(is_numeric_line(line) for line in lines) and any(line.strip() for line in lines):
+        result['dropped'] = 0
+        return result
+
+    new_content = '\n'.join(new_lines) + ('\n' if new_lines else '')
+    new_rawdata = new_content.encode('utf-8')
+    if new_rawdata != rawdata:
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(new_rawdata)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
+        result['rewritten'] = True
+    return result
+
+
+# This function cleans up the .txt files of the folder: commas removed, boxes clamped to the image,
+# degenerate boxes dropped and files re-encoded in UTF-8. The files are processed by a pool of processes.
+def clean_comma(folder, workers=None):
+    with os.scandir(folder) as entries:
+        paths = [entry.path for entry in entries
+                 if entry.name.endswith('.txt') and entry.name not in SET_FILES and entry.is_file()]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(normalize_label_file, paths, chunksize=256))
+
+    rewritten = sum(result['rewritten'] for result in results)
+    print(f"{len(results)} label files checked, {rewritten} rewritten, "
+          f"{sum(result['clamped'] for result in results)} boxes clamped, {sum(result['dropped'] for result in results)} lines dropped")
+    for result in results:
+        if result['encoding'] != 'utf-8':
+            print(f"{result['file']} was encoded in {result['encoding'] or 'an unknown encoding'}, rewritten in UTF-8")
+    return results
 
-# This function cleans up the .txt file in the csv file to remove commas
-def clean_comma(folder):
-    for filename in os.listdir(folder):
-        if filename.endswith('.txt'):
-            file_path = os.path.join(folder, filename)
-            
-            # Read the file content
-            with open(file_path, 'r') as file:
-                content = file.read()
-            
-            # Remove commas
-            content_without_comma = content.replace(',', '')
-            
-            # Write the modified content in the file
-            with open(file_path, 'w') as file:
-                file.write(content_without_comma)
-                
 # This function create three files one for each set : train, val and test
 def create_txt_train_val_test(folder):
     # Get a list of the images
@@ -71,24 +162,177 @@ def create_txt_train_val_test(folder):
 
 
 
+# Name of the manuscript of an image: the basename without the number of the folio
+MANUSCRIPT_PATTERN = re.compile(r'^(.+)_\d+\.')
+
+# This function create the same three files as create_txt_train_val_test, but all the images of a manuscript
+# go to the same set, so that folios of a manuscript seen in training are not used to test the model.
+# The manuscripts are distributed so that each set gets its share of images and of each class.
+# 'duplicate_clusters' (lists of paths of near-duplicate images, see dedup_index.py) puts the manuscripts
+# sharing a duplicate in the same set, so that the same folio is never both in training and in test.
+def create_grouped_txt_train_val_test(folder, ratios=(0.8, 0.1, 0.1), seed=0, duplicate_clusters=None):
+    # Get a list of the images, with a single listing of the folder
+    with os.scandir(folder) as entries:
+        image_files = sorted(entry.name for entry in entries if entry.name.endswith(".jpg") or entry.name.endswith(".png"))
+
+    # Classes of each image, read from the label store of the folder (only modified label files are read again)
+    store = build_label_store(folder)
+
+    # Group the images by manuscript and count the boxes of each class in each manuscript
+    groups = {}
+    for image_file in image_files:
+        match = MANUSCRIPT_PATTERN.match(image_file)
+        manuscript = match.group(1) if match else os.path.splitext(image_file)[0]
+        group = groups.setdefault(manuscript, {'images': [], 'classes': Counter()})
+        group['images'].append(image_file)
+        label_file = os.path.splitext(image_file)[0] + '.txt'
+        if label_file in store:
+            group['classes'].update(int(code) for code in store.boxes_of(label_file)[:, 0])
+
+    # Manuscripts sharing near-duplicate images are merged into one group
+    if duplicate_clusters:
+        manuscript_of = {image_file: name for name, group in groups.items() for image_file in group['images']}
+        for cluster in duplicate_clusters:
+            names = sorted({manuscript_of[os.path.basename(path)] for path in cluster
+                            if os.path.basename(path) in manuscript_of})
+            for name in names[1:]:
+                group = groups.pop(name)
+                groups[names[0]]['images'].extend(group['images'])
+                groups[names[0]]['classes'].update(group['classes'])
+                for image_file in group['images']:
+                    manuscript_of[image_file] = names[0]
+
+    # Targets of each set
+    total_images = len(image_files)
+    total_classes = Counter()
+    for group in groups.values():
+        total_classes.update(group['classes'])
+    targets = [{'images': total_images * ratio, 'classes': {code: count * ratio for code, count in total_classes.items()}}
+               for ratio in ratios]
+    current = [{'images': 0, 'classes': Counter()} for _ in ratios]
+
+    # Largest manuscripts first (random order between manuscripts of the same size, reproducible from the seed)
+    names = sorted(groups)
+    random.Random(seed).shuffle(names)
+    names.sort(key=lambda name: len(groups[name]['images']), reverse=True)
+
+    sets = [[] for _ in ratios]
+    for name in names:
+        group = groups[name]
+        # Each manuscript goes to the set which most lacks images and boxes of its classes
+        def need(i):
+            score = (targets[i]['images'] - current[i]['images']) / max(targets[i]['images'], 1)
+            if group['classes']:
+                score += sum((targets[i]['classes'][code] - current[i]['classes'][code]) / max(targets[i]['classes'][code], 1)
+                             for code in group['classes']) / len(group['classes'])
+            return score
+        best = max((i for i in range(len(ratios)) if ratios[i] > 0), key=need)
+        sets[best].extend(group['images'])
+        current[best]['images'] += len(group['images'])
+        current[best]['classes'].update(group['classes'])
+
+    for set_name, files, counts in zip(("train", "val", "test"), sets, current):
+        print(f"{set_name}: {len(files)} images, classes {dict(sorted(counts['classes'].items()))}")
+
+    write_set_files(folder, sets[0], sets[1], sets[2], image_files)
+
+
+# This function writes the three files of the sets and the file with all the dataset
+def write_set_files(folder, train_files, val_files, test_files, image_files):
+    for filename, files in (("traindata.txt", train_files), ("valdata.txt", val_files),
+                            ("testdata.txt", test_files), ("train_dataset.txt", image_files)):
+        with open(os.path.join(folder, filename), "w") as f:
+            for image_file in files:
+                f.write(os.path.join(folder, image_file) + "\n")
+
+
+# Linux ioctl to clone a file (reflink) on filesystems which support it (Btrfs, XFS...)
+FICLONE = 0x40049409
+
+# This function clones a file without copying its data, and raises OSError if it is not supported
+def reflink(src, dst):
+    import fcntl
+
+    with open(src, 'rb') as source, open(dst, 'wb') as destination:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+
+# This function puts the file src at dst: as a hardlink, a symlink, a reflink, a copy or by moving it.
+# Links which cannot be created (other filesystem, not supported) fall back on a copy.
+# If dst already points to src, nothing is done, so the function can be run several times.
+def place_file(src, dst, mode="hardlink"):
+    if mode == "move":
+        if os.path.exists(src):
+            shutil.move(src, dst)
+        return
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        if mode in ("copy", "reflink") and not os.path.islink(dst):
+            src_stat, dst_stat = os.stat(src), os.stat(dst)
+            if src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns <= dst_stat.st_mtime_ns:
+                return
+
+    # The file is created under a temporary name and renamed, so dst is never half written
+    tmp = dst + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        if mode == "hardlink":
+            os.link(src, tmp)
+        elif mode == "symlink":
+            os.symlink(os.path.abspath(src), tmp)
+        elif mode == "reflink":
+            reflink(src, tmp)
+        else:
+            shutil.copy2(src, tmp)
+    except (OSError, ImportError):
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
 # Function to distribute images and txt files to different folders from a .txt file
-def split_data_for_training(txt_list, output_img_folder, output_txt_folder):
+# With mode="move" (the default) the files are moved as before. With mode="hardlink", "symlink", "reflink" or "copy"
+# the source folder is kept, so several splits or cross-validation folds can share the same images.
+def split_data_for_training(txt_list, output_img_folder, output_txt_folder, mode="move", workers=8):
     # Create the output folder if it does not already exist
     os.makedirs(output_img_folder, exist_ok=True)
     os.makedirs(output_txt_folder, exist_ok=True)
     
     # Open the text file containing the image paths
+    jobs = []
     with open(txt_list, "r") as f:
         for line in f:
             image_path = line.strip()
+            if not image_path:
+                continue
             txt_file = os.path.splitext(os.path.basename(image_path))[0] + ".txt"
             
-            # Move the image to the output folder
-            shutil.move(image_path, os.path.join(output_img_folder, os.path.basename(image_path)))
+            # The image to the output folder
+            jobs.append((image_path, os.path.join(output_img_folder, os.path.basename(image_path))))
             
-            # Move the text file to the output folder
-            shutil.move(os.path.join(os.path.dirname(image_path), txt_file), os.path.join(output_txt_folder, txt_file))
+            # The text file to the output folder
+            jobs.append((os.path.join(os.path.dirname(image_path), txt_file), os.path.join(output_txt_folder, txt_file)))
+
+    # The files are placed in parallel
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(place_file, src, dst, mode) for src, dst in jobs]:
+            future.result()
+
+
+# This function builds images/{train,val,test} and labels/{train,val,test} in output_folder from the three set files,
+# with links to the images of the source folder
+def materialize_dataset(folder, output_folder, mode="hardlink", workers=8):
+    for set_name, txt_list in (("train", "traindata.txt"), ("val", "valdata.txt"), ("test", "testdata.txt")):
+        split_data_for_training(os.path.join(folder, txt_list),
+                                os.path.join(output_folder, "images", set_name),
+                                os.path.join(output_folder, "labels", set_name),
+                                mode=mode, workers=workers)
+
 
-split_data_for_training('traindata.txt', 'images/train', 'labels/train')
-split_data_for_training('valdata.txt', 'images/val', 'labels/val')
-split_data_for_training('testdata.txt', 'images/test', 'labels/test')
+if __name__ == '__main__':
+    split_data_for_training('traindata.txt', 'images/train', 'labels/train')
+    split_data_for_training('valdata.txt', 'images/val', 'labels/val')
+    split_data_for_training('testdata.txt', 'images/test', 'labels/test')
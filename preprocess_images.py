@@ -0,0 +1,296 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Preprocessing of the images of an annotated dataset for the YOLO training.
+The folios are downloaded at full resolution: each image is resized once to the training size
+(letterbox: the image is scaled to fit in size x size pixels and padded), instead of being decoded and resized
+at every epoch. Optionally, the very large folios are cut into overlapping tiles, each tile being letterboxed.
+The YOLO label files are remapped to the new images.
+The images are processed by a pool of processes. The results are cached by the SHA-256 of the source image
+and of its label file: an image is only processed again if it changed or if the parameters changed.
+
+    python preprocess_images.py <folder> <output_folder> [size] [tile_size]
+"""
+
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from image_probe import probe_image_size
+from label_store import read_label_file
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Grey of the padding, as in the YOLO letterbox
+PAD_COLOR = (114, 114, 114)
+INDEX_NAME = '.preprocess_index.json'
+# Reduced decoding of OpenCV: the JPEG is decoded directly at 1/2, 1/4 or 1/8 of its size
+REDUCED_MODES = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_image(path, size=None):
+    """
+    Reads an image with OpenCV. When only a size x size version is needed, a large JPEG is decoded at a reduced
+    scale (still larger than 'size'), which is much faster than decoding the full image.
+    Returns (image, full width, full height).
+    """
+    try:
+        width, height = probe_image_size(path)
+    except Exception:
+        width = height = None
+
+    image = None
+    if size and width and path.lower().endswith(('.jpg', '.jpeg')):
+        for factor, mode in REDUCED_MODES:
+            if max(width, height) // factor >= size:
+                image = cv2.imread(path, mode | cv2.IMREAD_IGNORE_ORIENTATION)
+                break
+    if image is None:
+        # The orientation is ignored, as for the header: the pixels match the coordinates of the labels
+        image = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise ValueError(f'cannot read image {path}')
+    if width is None:
+        height, width = image.shape[:2]
+    return image, width, height
+
+
+def letterbox(image, size, scaleup=False):
+    """
+    Scales the image to fit in size x size pixels, keeping its aspect ratio, and pads it.
+    Returns (new image, scale, (pad_x, pad_y)), the scale being relative to the image given.
+    """
+    height, width = image.shape[:2]
+    scale = min(size / width, size / height)
+    if not scaleup:
+        scale = min(scale, 1.0)
+    new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+    if (new_width, new_height) != (width, height):
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        image = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+    pad_x, pad_y = (size - new_width) // 2, (size - new_height) // 2
+    image = cv2.copyMakeBorder(image, pad_y, size - new_height - pad_y, pad_x, size - new_width - pad_x,
+                               cv2.BORDER_CONSTANT, value=PAD_COLOR)
+    return image, scale, (pad_x, pad_y)
+
+
+def to_corners(boxes, width, height):
+    """YOLO boxes (class, x, y, w, h, ...) in relative coordinates -> (x_min, y_min, x_max, y_max) in pixels."""
+    x, y, w, h = boxes[:, 1] * width, boxes[:, 2] * height, boxes[:, 3] * width, boxes[:, 4] * height
+    return np.stack([x - w / 2, y - h / 2, x + w / 2, y + h / 2], axis=1)
+
+
+def to_yolo(classes, corners, extra, size):
+    """Corners in pixels of a size x size image -> YOLO label lines."""
+    lines = []
+    for class_code, (x_min, y_min, x_max, y_max), values in zip(classes, corners, extra):
+        row = [(x_min + x_max) / 2 / size, (y_min + y_max) / 2 / size, (x_max - x_min) / size, (y_max - y_min) / size]
+        line = f'{int(class_code)} ' + ' '.join(f'{value:.6f}' for value in row)
+        if len(values) and not np.isnan(values[0]):
+            line += f' {values[0]:.6f}'
+        lines.append(line)
+    return lines
+
+
+def tile_origins(length, tile_size, overlap):
+    """Start positions of the tiles along one dimension, the last tile ending at the edge of the image."""
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+
+def tiles(width, height, tile_size, overlap):
+    """Windows (x, y, w, h) covering the image with overlapping tiles."""
+    return [(x, y, min(tile_size, width), min(tile_size, height))
+            for y in tile_origins(height, tile_size, overlap) for x in tile_origins(width, tile_size, overlap)]
+
+
+def write_image(path, image, quality=95):
+    tmp_path = path + '.tmp' + os.path.splitext(path)[1]
+    if not cv2.imwrite(tmp_path, image, [cv2.IMWRITE_JPEG_QUALITY, quality]):
+        raise ValueError(f'cannot write image {path}')
+    os.replace(tmp_path, path)
+
+
+def write_labels(path, lines):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(''.join(line + '\n' for line in lines))
+    os.replace(tmp_path, path)
+
+
+def preprocess_image(image_path, label_path, output_folder, size=640, tile_size=None, overlap=0.2,
+                     min_visibility=0.5, quality=95):
+    """
+    Letterboxes one image (or each of its tiles, if its largest side is over 'tile_size' pixels) to size x size
+    and writes the images and their label files in output_folder. A box cut by a tile is kept in the tile,
+    clipped, if at least 'min_visibility' of its area is in the tile.
+    Returns the names of the files written; if the image fails, the files already written are removed.
+    """
+    stem, extension = os.path.splitext(os.path.basename(image_path))
+    extension = '.png' if extension.lower() == '.png' else '.jpg'
+    boxes = read_label_file(label_path) if label_path else None
+
+    tiling = tile_size and max(probe_image_size(image_path)) > tile_size
+    image, width, height = read_image(image_path, None if tiling else size)
+    # The image may have been decoded at a reduced scale
+    decoded_scale = image.shape[1] / width
+
+    windows = tiles(width, height, tile_size, overlap) if tiling else [(0, 0, width, height)]
+    written = []
+    try:
+        _write_windows(image, boxes, windows, width, height, decoded_scale, stem, extension, output_folder, size,
+                       min_visibility, quality, written)
+    except BaseException:
+        # No partial output (some tiles only) is left for an image which failed
+        for output in written:
+            if os.path.exists(os.path.join(output_folder, output)):
+                os.remove(os.path.join(output_folder, output))
+        raise
+    return written
+
+
+def _write_windows(image, boxes, windows, width, height, decoded_scale, stem, extension, output_folder, size,
+                   min_visibility, quality, written):
+    """Letterboxes and writes each window (x, y, w, h) of the image and its labels; the names are added to 'written'."""
+    for x, y, w, h in windows:
+        crop = image[round(y * decoded_scale):round((y + h) * decoded_scale),
+                     round(x * decoded_scale):round((x + w) * decoded_scale)]
+        new_image, scale, (pad_x, pad_y) = letterbox(crop, size)
+        name = stem if len(windows) == 1 else f'{stem}.tile{x}-{y}'
+        write_image(os.path.join(output_folder, name + extension), new_image, quality)
+        written.append(name + extension)
+
+        if boxes is None:
+            continue
+        corners = to_corners(boxes, width, height)
+        clipped = np.stack([np.clip(corners[:, 0], x, x + w), np.clip(corners[:, 1], y, y + h),
+                            np.clip(corners[:, 2], x, x + w), np.clip(corners[:, 3], y, y + h)], axis=1)
+        area = (corners[:, 2] - corners[:, 0]) * (corners[:, 3] - corners[:, 1])
+        visible = (clipped[:, 2] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 1])
+        keep = (visible > 0) & (visible >= min_visibility * np.maximum(area, 1e-9))
+        # Coordinates in the letterboxed image
+        scale = scale * decoded_scale
+        new_corners = (clipped[keep] - [x, y, x, y]) * scale + [pad_x, pad_y, pad_x, pad_y]
+        write_labels(os.path.join(output_folder, name + '.txt'), to_yolo(boxes[keep, 0], new_corners, boxes[keep, 5:], size))
+        written.append(name + '.txt')
+
+
+def _remove_outputs(output_folder, outputs):
+    for output in outputs:
+        if os.path.exists(os.path.join(output_folder, output)):
+            os.remove(os.path.join(output_folder, output))
+
+
+def _preprocess_job(job):
+    image_path, label_path, output_folder, params = job
+    try:
+        return preprocess_image(image_path, label_path, output_folder, **params), ''
+    except Exception as e:
+        return [], str(e)
+
+
+def preprocess_folder(folder, output_folder, size=640, tile_size=None, overlap=0.2, min_visibility=0.5,
+                      quality=95, workers=None):
+    """
+    Preprocesses all the images of 'folder' (see preprocess_image) into output_folder.
+    Only the images whose content (or label file) changed since the last run, or all of them if the parameters
+    changed, are processed again. The files of removed images are deleted.
+    Returns the number of images processed.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    params = {'size': size, 'tile_size': tile_size, 'overlap': overlap, 'min_visibility': min_visibility,
+              'quality': quality}
+    index_path = os.path.join(output_folder, INDEX_NAME)
+    index = {'params': params, 'images': {}}
+    # Outputs of the previous run, deleted when their image is processed again, fails or is removed
+    previous_images = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        previous_images = previous['images']
+        if previous.get('params') == params:
+            index['images'] = previous_images
+
+    with os.scandir(folder) as entries:
+        files = {entry.name: entry for entry in entries if entry.is_file()}
+
+    jobs = []
+    current = {}
+    for name in sorted(files):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        label_name = os.path.splitext(name)[0] + '.txt'
+        label_path = files[label_name].path if label_name in files else None
+        # The hashes are only computed again if the modification time or the size changed
+        stats = [[files[n].stat().st_mtime_ns, files[n].stat().st_size] for n in (name, label_name) if n in files]
+        entry = index['images'].get(name)
+        if entry is not None and entry['stats'] == stats:
+            current[name] = entry
+            continue
+        sha256 = [file_hash(files[n].path) for n in (name, label_name) if n in files]
+        outputs_exist = entry is not None and all(os.path.exists(os.path.join(output_folder, output))
+                                                  for output in entry['outputs'])
+        if entry is not None and entry['sha256'] == sha256 and outputs_exist:
+            current[name] = dict(entry, stats=stats)
+            continue
+        current[name] = {'stats': stats, 'sha256': sha256, 'outputs': []}
+        jobs.append((files[name].path, label_path, output_folder, params))
+
+    # The outputs of a previous version of the images processed again are deleted first, so that the outputs
+    # of an image which fails (or tiles which are not produced anymore) are not used as if they were current
+    for image_path, _, _, _ in jobs:
+        name = os.path.basename(image_path)
+        if name in previous_images:
+            _remove_outputs(output_folder, previous_images.pop(name)['outputs'])
+
+    reused = len(current) - len(jobs)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for (image_path, _, _, _), (written, error) in zip(jobs, executor.map(_preprocess_job, jobs, chunksize=16)):
+            name = os.path.basename(image_path)
+            if error:
+                print(f'Error while preprocessing {image_path}. Error message: {error}')
+                failed += 1
+                del current[name]
+                continue
+            current[name]['outputs'] = written
+
+    # Removed images (and images of a run with other parameters)
+    for name in set(previous_images) - set(current):
+        _remove_outputs(output_folder, previous_images[name]['outputs'])
+
+    index['images'] = current
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    print(f'{len(jobs) - failed} images preprocessed, {reused} reused, {failed} failed in {output_folder}')
+    return len(jobs) - failed
+
+
+if __name__ == '__main__':
+    preprocess_folder(sys.argv[1], sys.argv[2],
+                      size=int(sys.argv[3]) if len(sys.argv) > 3 else 640,
+                      tile_size=int(sys.argv[4]) if len(sys.argv) > 4 else None)
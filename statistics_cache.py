@@ -0,0 +1,166 @@
+"""
+Marion Charpier
+---
+This script was produced as part of an M2 TNAH internship at the École des Chartes,
+under the joint supervision of the University of Humboldt (Berlin) and the IRHT-CNRS (Paris).
+---
+
+Incremental cache of the dataset statistics.
+The statistics of each annotation file (number of lines, class histogram, emptiness, encoding,
+box sizes) are stored in a SQLite file with the modification time and the size of the file.
+The class totals are integer counts, only updated with the difference between the old and the new
+histogram of the files which changed; the other aggregates are recomputed from the per-file rows, so
+the report is the same as collect_statistics. After an annotation session, only the modified label
+files are read again.
+
+    python statistics_cache.py <folder> [report.json]
+"""
+
+import json
+import os
+import sqlite3
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from Statistics_scipts_for_annotated_data import (BOX_SIZE_KEYS, IMAGE_EXTENSIONS, annotation_file_statistics,
+                                                  statistics_summary)
+
+
+# Version of the cache tables: an older cache is dropped and rebuilt
+CACHE_VERSION = 2
+
+
+class StatisticsCache:
+
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(db_path)
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            self.connection.execute('DROP TABLE IF EXISTS files')
+            self.connection.execute('DROP TABLE IF EXISTS totals')
+            self.connection.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'name TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, lines INTEGER, annotations INTEGER, '
+            'empty INTEGER, encoding TEXT, classes TEXT, boxes INTEGER, sum_width REAL, sum_height REAL, '
+            'min_area REAL, max_area REAL)'
+        )
+        # Only integer counts are updated incrementally: the float sums are recomputed from the files table
+        self.connection.execute('CREATE TABLE IF NOT EXISTS totals (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self.connection.commit()
+
+    def _apply(self, classes, sign, totals):
+        """Adds (sign=1) or removes (sign=-1) the class histogram of one file from the totals."""
+        for class_code, count in classes.items():
+            totals['class:' + class_code] += sign * count
+
+    def update(self, folder, annotation_files, parallel_above=2000):
+        """
+        Updates the cache with 'annotation_files', a dictionary {name: (mtime_ns, size)} of the current
+        annotation files of 'folder'. Returns the number of files read.
+        When more than 'parallel_above' files changed (first run), they are read by a process pool.
+        """
+        known = {name: (mtime_ns, size) for name, mtime_ns, size
+                 in self.connection.execute('SELECT name, mtime_ns, size FROM files')}
+        changed = [name for name, stat in annotation_files.items() if known.get(name) != stat]
+        removed = [name for name in known if name not in annotation_files]
+        if not changed and not removed:
+            return 0
+
+        totals = Counter(dict(self.connection.execute('SELECT key, value FROM totals')))
+        for name in removed + [name for name in changed if name in known]:
+            (classes,) = self.connection.execute('SELECT classes FROM files WHERE name = ?', (name,)).fetchone()
+            self._apply(json.loads(classes), -1, totals)
+        self.connection.executemany('DELETE FROM files WHERE name = ?', [(name,) for name in removed])
+
+        paths = [os.path.join(folder, name) for name in changed]
+        if len(paths) > parallel_above:
+            with ProcessPoolExecutor() as executor:
+                all_statistics = list(executor.map(annotation_file_statistics, paths, chunksize=256))
+        else:
+            all_statistics = [annotation_file_statistics(path) for path in paths]
+
+        for name, statistics in zip(changed, all_statistics):
+            self._apply(statistics['classes'], 1, totals)
+            mtime_ns, size = annotation_files[name]
+            sizes = statistics['box_sizes']
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, mtime_ns, size, statistics['lines'], statistics['annotations'], int(statistics['empty']),
+                 statistics['encoding'], json.dumps(statistics['classes']),
+                 *(sizes[key] for key in BOX_SIZE_KEYS)))
+
+        self.connection.execute('DELETE FROM totals')
+        self.connection.executemany('INSERT INTO totals VALUES (?, ?)',
+                                    [(key, value) for key, value in totals.items() if value])
+        self.connection.commit()
+        return len(changed)
+
+    def classes(self):
+        """Number of annotations of each class, kept up to date by update()."""
+        return Counter({key[len('class:'):]: value for key, value
+                        in self.connection.execute('SELECT key, value FROM totals') if key.startswith('class:')})
+
+    def files(self):
+        """
+        Returns {name: (lines, empty, encoding)} and the list of the box size summaries (values of
+        BOX_SIZE_KEYS) of the cached annotation files.
+        """
+        per_file, box_sizes = {}, []
+        for name, lines, empty, encoding, *sizes in self.connection.execute(
+                'SELECT name, lines, empty, encoding, ' + ', '.join(BOX_SIZE_KEYS) + ' FROM files'):
+            per_file[name] = (lines, bool(empty), encoding)
+            box_sizes.append(tuple(sizes))
+        return per_file, box_sizes
+
+    def close(self):
+        self.connection.close()
+
+
+def scan_folder(folder):
+    """
+    Lists the folder once: returns the sorted image files and a dictionary {annotation file: (mtime_ns, size)}
+    for the annotation files which have an image.
+    """
+    entries = {}
+    with os.scandir(folder) as scan:
+        for entry in scan:
+            if entry.is_file():
+                entries[entry.name] = entry
+    image_files = sorted(name for name in entries if name.endswith(IMAGE_EXTENSIONS))
+    annotation_files = {}
+    for image_file in image_files:
+        annotation_file = f"{os.path.splitext(image_file)[0]}.txt"
+        if annotation_file in entries:
+            stat = entries[annotation_file].stat()
+            annotation_files[annotation_file] = (stat.st_mtime_ns, stat.st_size)
+    return image_files, annotation_files
+
+
+def incremental_statistics(folder, cache_path=None):
+    """
+    Statistics of 'folder', reading only the annotation files added or modified since the last call.
+    The report is the same as the one of collect_statistics. Returns the statistics and the number of
+    annotation files read. The cache is stored in '<folder>/.statistics_cache.sqlite' by default.
+    """
+    if cache_path is None:
+        cache_path = os.path.join(folder, '.statistics_cache.sqlite')
+    image_files, annotation_files = scan_folder(folder)
+
+    cache = StatisticsCache(cache_path)
+    nb_read = cache.update(folder, annotation_files)
+    classes = cache.classes()
+    per_file, box_sizes = cache.files()
+    cache.close()
+
+    statistics = statistics_summary(folder, image_files, list(annotation_files), classes, per_file, box_sizes)
+    return statistics, nb_read
+
+
+if __name__ == '__main__':
+    statistics, nb_read = incremental_statistics(sys.argv[1])
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w', encoding='utf-8') as f:
+            json.dump(statistics, f, ensure_ascii=False, indent=2)
+    print(f"{nb_read} fichiers d'annotations lus")
+    print(f"Le total des annotations est {statistics['total_annotations']}.")